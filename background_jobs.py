@@ -0,0 +1,67 @@
+# Bounded executor for background generation jobs
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while every worker and queue slot is taken."""
+
+
+class JobExecutor:
+    """
+    Thread pool with a bounded queue.
+
+    At most `max_workers` jobs run at once and at most `max_queue` more wait
+    for a worker. Submitting beyond that raises QueueFullError instead of
+    piling up threads (and the prompts they hold) under a burst of requests.
+    """
+    def __init__(self, max_workers=4, max_queue=16, name="jobs"):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0  # Submitted jobs that have not finished yet
+        self._running = 0
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def queue_depth(self):
+        """Number of jobs waiting for a worker."""
+        return max(0, self._pending - self._running)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) and return its Future.
+
+        Raises QueueFullError when the queue is full and RuntimeError after shutdown().
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError(f"{self._pending} jobs already pending")
+
+        def run():
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._pending -= 1
+                self._slots.release()
+
+        with self._lock:
+            self._pending += 1
+        try:
+            return self._executor.submit(run)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+            raise
+
+    def shutdown(self, wait=False):
+        self._executor.shutdown(wait=wait)
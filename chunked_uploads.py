@@ -0,0 +1,178 @@
+# Resumable uploads assembled from chunks in a staging directory
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the threads of one process are serialized
+    fcntl = None
+
+from document_extraction import UploadBuffer
+
+logger = logging.getLogger(__name__)
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class UploadNotFoundError(Exception):
+    """Raised for upload ids that don't exist (never created, finalized or expired)."""
+
+
+class ChunkOffsetError(Exception):
+    """Raised when a chunk doesn't start where the staged data ends."""
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+class ChunkedUploadStaging:
+    """
+    Staging area for uploads sent in chunks.
+
+    Each upload is a `<id>.part` file holding the bytes received so far plus a
+    `<id>.json` file with its name and announced size. The current offset is
+    simply the size of the part file, so after a dropped connection a client
+    asks for the status and resumes from there, and any worker sharing the
+    directory can take the next chunk. Uploads untouched for `ttl` seconds are
+    removed by sweep().
+    """
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, ttl=24 * 3600, lock_stripes=64):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._stripes = [threading.Lock() for _ in range(max(1, lock_stripes))]
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, upload_id):
+        if not upload_id or not _UPLOAD_ID.match(upload_id):
+            raise UploadNotFoundError(upload_id)
+        base = os.path.join(self.directory, upload_id)
+        return f"{base}.part", f"{base}.json"
+
+    def _lock_for(self, upload_id):
+        return self._stripes[hash(upload_id) % len(self._stripes)]
+
+    @contextmanager
+    def _locked_part(self, upload_id):
+        """
+        Open the upload's part file for writing and hold its locks meanwhile.
+
+        A striped lock serializes the threads of this process and flock() on
+        the part file serializes the workers sharing the staging directory, so
+        checking the offset and appending happen as one step.
+        """
+        part_path, _ = self._paths(upload_id)
+        with self._lock_for(upload_id):
+            try:
+                f = open(part_path, 'r+b')
+            except FileNotFoundError:
+                raise UploadNotFoundError(upload_id)
+            with f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                yield f
+
+    def create(self, file_name, size, file_type=None):
+        """Start a new upload of `size` bytes and return its status."""
+        if size < 0 or (self.max_bytes is not None and size > self.max_bytes):
+            raise ValueError(f"Upload size must be between 0 and {self.max_bytes} bytes")
+        self.sweep()
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._paths(upload_id)
+        meta = {
+            'upload_id': upload_id,
+            'file_name': file_name,
+            'file_type': file_type,
+            'size': size,
+            'created_at': time.time()
+        }
+        open(part_path, 'wb').close()
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        return dict(meta, offset=0, complete=size == 0)
+
+    def status(self, upload_id):
+        """Return the upload's metadata with the number of bytes received so far as 'offset'."""
+        part_path, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            offset = os.path.getsize(part_path)
+        except (FileNotFoundError, ValueError):
+            raise UploadNotFoundError(upload_id)
+        return dict(meta, offset=offset, complete=offset == meta['size'])
+
+    def write_chunk(self, upload_id, offset, stream, block_size=1024 * 1024):
+        """
+        Append the bytes read from `stream` at `offset` and return the new offset.
+
+        The chunk must start exactly at the current end of the staged data;
+        otherwise ChunkOffsetError carries the offset to resume from.
+        """
+        with self._locked_part(upload_id) as f:
+            status = self.status(upload_id)
+            if offset != status['offset']:
+                raise ChunkOffsetError(f"Chunk starts at {offset} but {status['offset']} bytes are staged",
+                                       status['offset'])
+            written = 0
+            f.seek(offset)
+            for block in iter(lambda: stream.read(block_size), b''):
+                if offset + written + len(block) > status['size']:
+                    # Drop the oversized chunk so the client can resend it correctly
+                    f.truncate(offset)
+                    raise ChunkOffsetError(f"Chunk goes past the announced size of {status['size']} bytes",
+                                           offset)
+                f.write(block)
+                written += len(block)
+            f.flush()
+            for path in self._paths(upload_id):
+                os.utime(path)
+            return offset + written
+
+    def finalize(self, upload_id):
+        """
+        Finish a complete upload and return (metadata, UploadBuffer) for its content.
+
+        The buffer takes over the staged file, so closing it deletes the file.
+        """
+        part_path, meta_path = self._paths(upload_id)
+        with self._locked_part(upload_id):
+            status = self.status(upload_id)
+            if not status['complete']:
+                raise ChunkOffsetError(f"Upload has {status['offset']} of {status['size']} bytes",
+                                       status['offset'])
+            upload = UploadBuffer.from_path(part_path)
+            os.remove(meta_path)
+        return status, upload
+
+    def abort(self, upload_id):
+        """Discard an upload and its staged data."""
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def sweep(self, now=None):
+        """Remove uploads that haven't received data for longer than the ttl."""
+        if self.ttl is None:
+            return
+        now = time.time() if now is None else now
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.ttl:
+                    os.remove(path)
+                    logger.info(f"Removed stale upload file {name}")
+            except OSError:
+                pass
@@ -0,0 +1,152 @@
+# Reusable API clients keyed by a hash of their API key
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+def key_fingerprint(api_key):
+    """SHA-256 of an API key, so pools never hold raw keys as lookup keys."""
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+def create_shared_http_client(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60.0):
+    """
+    Return an httpx.Client whose connection pool can be shared by several API clients.
+
+    Returns None when httpx isn't installed; each client then keeps its own pool.
+    """
+    if httpx is None:
+        return None
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry
+    )
+    return httpx.Client(limits=limits, follow_redirects=True)
+
+
+def create_http_session(pool_size=20, pool_connections=4):
+    """
+    Return a requests.Session that keeps up to `pool_size` connections per host alive.
+
+    The adapter never retries by itself (max_retries=0); callers apply their
+    own retry policy, so a failed attempt isn't silently repeated underneath it.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class ClientPool:
+    """
+    Cache of API clients built by `factory(api_key)`, keyed by key fingerprint.
+
+    Reusing a client keeps its connections warm, so repeat requests with the
+    same key skip client construction and the TLS handshake. Clients unused
+    for `idle_ttl` seconds are dropped, and beyond `max_clients` the least
+    recently used one goes. Dropped clients aren't closed: they may share an
+    HTTP connection pool with clients that are still in use.
+    """
+    def __init__(self, factory, idle_ttl=600, max_clients=64, name="client-pool"):
+        self.factory = factory
+        self.idle_ttl = idle_ttl
+        self.max_clients = max_clients
+        self.name = name
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()  # fingerprint -> [client, last_used]
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _evict_idle(self, now):
+        while self._clients:
+            fingerprint, (_, last_used) = next(iter(self._clients.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            del self._clients[fingerprint]
+            logger.debug(f"{self.name}: dropped idle client {fingerprint[:12]}")
+
+    def get(self, api_key):
+        """Return the pooled client for api_key, creating it on first use."""
+        fingerprint = key_fingerprint(api_key)
+        with self._lock:
+            now = time.time()
+            self._evict_idle(now)
+            entry = self._clients.get(fingerprint)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(fingerprint)
+                return entry[0]
+
+        # Build outside the lock so a slow construction doesn't block other keys
+        client = self.factory(api_key)
+        with self._lock:
+            entry = self._clients.get(fingerprint)
+            if entry is not None:
+                # Another request built one meanwhile; keep a single client per key
+                entry[1] = time.time()
+                return entry[0]
+            self._clients[fingerprint] = [client, time.time()]
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+        return client
+
+
+class InvalidAPIKeyError(ValueError):
+    """Raised for API keys that are empty or that the provider rejected."""
+
+
+class KeyVerifier:
+    """
+    Checks API keys against the provider, remembering keys that passed.
+
+    `check(api_key)` makes a cheap authenticated request and returns True when
+    the key is accepted, False when it is rejected (or raises when the check
+    itself fails). Accepted keys are remembered by fingerprint for `ttl`
+    seconds, so only the first request with a key in that window pays for
+    the round trip. Rejected keys are not remembered, and neither is the
+    outcome of a check that failed (an outage or rate limit at the provider):
+    such keys are let through unverified.
+    """
+    def __init__(self, check, ttl=600, name="key-verifier"):
+        self.check = check
+        self.ttl = ttl
+        self.name = name
+        self._lock = threading.Lock()
+        self._verified = {}  # fingerprint -> time the key was last accepted
+
+    def verify(self, api_key):
+        """Raise InvalidAPIKeyError if api_key is empty or the provider rejects it."""
+        if not api_key or not api_key.strip():
+            raise InvalidAPIKeyError("API key cannot be empty")
+        fingerprint = key_fingerprint(api_key)
+        now = time.time()
+        with self._lock:
+            verified_at = self._verified.get(fingerprint)
+            if verified_at is not None and now - verified_at <= self.ttl:
+                return
+        try:
+            accepted = self.check(api_key)
+        except Exception as e:
+            logger.warning(f"{self.name}: could not verify key {fingerprint[:12]}, letting it through: {str(e)}")
+            return
+        if not accepted:
+            raise InvalidAPIKeyError("API key was rejected by the provider")
+        with self._lock:
+            # Drop expired keys so the map stays as small as the set of active keys
+            self._verified = {key: at for key, at in self._verified.items() if now - at <= self.ttl}
+            self._verified[fingerprint] = now
@@ -0,0 +1,528 @@
+# Text extraction from uploaded documents
+import base64
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from xml.etree.ElementTree import iterparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import PyPDF2
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SPILL_THRESHOLD = 16 * 1024 * 1024
+DECODE_BLOCK_SIZE = 4 * 1024 * 1024  # Base64 characters decoded at a time (a multiple of 4)
+
+
+class UploadBuffer:
+    """
+    Binary content of an uploaded file.
+
+    Bytes are kept in memory until they grow past `spill_threshold`; beyond
+    that they move to a uniquely named temporary file, which close() deletes.
+    Readers get a fresh stream from open(), and PDF workers open the spilled
+    file by path instead of being sent a copy of the bytes.
+    """
+    def __init__(self, spill_threshold=DEFAULT_SPILL_THRESHOLD):
+        self.spill_threshold = spill_threshold
+        self.path = None
+        self._file = io.BytesIO()
+        self._size = 0
+        self._sha256 = None
+
+    @classmethod
+    def from_bytes(cls, data, spill_threshold=DEFAULT_SPILL_THRESHOLD):
+        upload = cls(spill_threshold)
+        if spill_threshold is None or len(data) <= spill_threshold:
+            # BytesIO shares the bytes object until it is written to, so this doesn't copy
+            upload._file = io.BytesIO(data)
+            upload._size = len(data)
+        else:
+            upload.write(data)
+        return upload
+
+    @classmethod
+    def from_stream(cls, stream, spill_threshold=DEFAULT_SPILL_THRESHOLD, block_size=1024 * 1024):
+        """Copy a binary stream (e.g. a multipart file part) into a new buffer block by block."""
+        upload = cls(spill_threshold)
+        try:
+            for block in iter(lambda: stream.read(block_size), b''):
+                upload.write(block)
+        except Exception:
+            upload.close()
+            raise
+        return upload
+
+    @classmethod
+    def from_path(cls, path):
+        """Wrap an existing file; the buffer takes ownership and close() deletes the file."""
+        upload = cls(spill_threshold=None)
+        upload._file = open(path, 'rb')
+        upload._size = os.path.getsize(path)
+        upload.path = path
+        return upload
+
+    def write(self, data):
+        if (self.path is None and self.spill_threshold is not None
+                and self._size + len(data) > self.spill_threshold):
+            self._spill()
+        self._file.seek(0, io.SEEK_END)
+        self._file.write(data)
+        self._size += len(data)
+        self._sha256 = None
+
+    # File-like reading, so the buffer can stand in for a werkzeug file part's stream
+    # (FileStorage.read() and save() read it directly). Writes always append.
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def _spill(self):
+        spilled = tempfile.NamedTemporaryFile(prefix='upload-', suffix='.bin', delete=False)
+        spilled.write(self._file.getbuffer())
+        self._file = spilled
+        self.path = spilled.name
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def open(self):
+        """Return a binary stream over the whole content, positioned at the start."""
+        if self.path is not None:
+            self._file.flush()
+            return open(self.path, 'rb')
+        # getvalue() and BytesIO(bytes) share the underlying bytes instead of copying them
+        return io.BytesIO(self._file.getvalue())
+
+    def getvalue(self):
+        """Return the content as bytes (reads the temporary file if spilled)."""
+        if self.path is not None:
+            with self.open() as f:
+                return f.read()
+        return self._file.getvalue()
+
+    def sha256(self):
+        """Hex SHA-256 of the content, hashed in blocks so spilled files aren't loaded whole."""
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            if self.path is None:
+                digest.update(self._file.getbuffer())
+            else:
+                with self.open() as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(block)
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+
+    def close(self):
+        self._file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _extract_page_range(source, start, end):
+    """Extract the text of pages [start, end) of a PDF given as a file path or bytes (runs in a worker process)."""
+    reader = PyPDF2.PdfReader(source if isinstance(source, str) else io.BytesIO(source))
+    return [reader.pages[page_num].extract_text() or "" for page_num in range(start, end)]
+
+
+def _page_ranges(page_count, parts):
+    """Split page_count pages into `parts` contiguous (start, end) ranges of near-equal size."""
+    size, extra = divmod(page_count, parts)
+    ranges = []
+    start = 0
+    for index in range(parts):
+        end = start + size + (1 if index < extra else 0)
+        if end > start:
+            ranges.append((start, end))
+        start = end
+    return ranges
+
+
+class PdfExtractor:
+    """
+    Extracts PDF text, spreading large documents over a process pool.
+
+    Text extraction in PyPDF2 is pure Python and CPU bound, so threads don't
+    help. Documents with at least `min_parallel_pages` pages are split into one
+    contiguous page range per worker; each worker parses the PDF once and
+    returns its pages, and the results are joined in page order. Smaller
+    documents are extracted in the calling process, where the pool's startup
+    and transfer costs would outweigh the gain.
+
+    The pool is created on first use and reused across requests. It uses the
+    'spawn' start method because the server process runs other threads.
+    """
+    def __init__(self, max_workers=4, min_parallel_pages=50):
+        self.max_workers = max_workers
+        self.min_parallel_pages = min_parallel_pages
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._pool
+
+    def _reset_pool(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+    def extract_text(self, upload):
+        """Return the text of every page of the PDF in an UploadBuffer (or bytes), one page per line block."""
+        if not isinstance(upload, UploadBuffer):
+            upload = UploadBuffer.from_bytes(upload, spill_threshold=None)
+        with upload.open() as stream:
+            reader = PyPDF2.PdfReader(stream)
+            page_count = len(reader.pages)
+
+            pages = None
+            if self.max_workers > 1 and page_count >= self.min_parallel_pages:
+                pages = self._extract_parallel(upload, page_count)
+            if pages is None:
+                pages = [reader.pages[page_num].extract_text() or "" for page_num in range(page_count)]
+
+        return "".join(page + "\n" for page in pages)
+
+    def _extract_parallel(self, upload, page_count):
+        """Extract pages on the pool; returns None if the pool fails so the caller can fall back."""
+        ranges = _page_ranges(page_count, min(self.max_workers, page_count))
+        # Spilled uploads are opened by path in the workers; small ones are sent as bytes
+        source = upload.path if upload.spilled else upload.getvalue()
+        try:
+            pool = self._get_pool()
+            futures = [pool.submit(_extract_page_range, source, start, end) for start, end in ranges]
+            pages = []
+            for future in futures:
+                pages.extend(future.result())
+            logger.info(f"Extracted {page_count} PDF pages with {len(ranges)} worker processes")
+            return pages
+        except BrokenProcessPool as e:
+            # A crashed worker breaks the whole pool; start a new one next time
+            logger.warning(f"PDF worker pool broke, falling back to a single process: {str(e)}")
+            self._reset_pool()
+            return None
+        except Exception as e:
+            logger.warning(f"Parallel PDF extraction failed, falling back to a single process: {str(e)}")
+            return None
+
+    def shutdown(self):
+        self._reset_pool()
+
+
+class DocumentExtractionError(Exception):
+    """Raised when an uploaded document can't be decoded or its text can't be extracted."""
+
+
+def file_type_from_name(file_name):
+    """Return the lower-case extension of a file name ('txt' if it has none)."""
+    return file_name.split('.')[-1].lower() if file_name and '.' in file_name else 'txt'
+
+
+def decode_upload(encoded, spill_threshold=DEFAULT_SPILL_THRESHOLD):
+    """
+    Decode base64 file content sent by the frontend into an UploadBuffer.
+
+    Accepts data URLs ("data:application/pdf;base64,...") as well as raw base64,
+    and repairs missing padding. The content is decoded block by block so a
+    large upload spills to disk without ever being held decoded in full.
+    """
+    if ';base64,' in encoded:
+        encoded = encoded.split(';base64,', 1)[1]
+    if len(encoded) % 4:
+        encoded += '=' * (4 - len(encoded) % 4)
+    upload = UploadBuffer(spill_threshold)
+    try:
+        for start in range(0, len(encoded), DECODE_BLOCK_SIZE):
+            upload.write(base64.b64decode(encoded[start:start + DECODE_BLOCK_SIZE]))
+    except (ValueError, TypeError) as e:
+        upload.close()
+        raise DocumentExtractionError(f"Error decoding base64 content: {str(e)}")
+    return upload
+
+
+_WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_BODY = _WORD_NS + 'body'
+_W_P = _WORD_NS + 'p'
+_W_R = _WORD_NS + 'r'
+_W_T = _WORD_NS + 't'
+_W_TAB = _WORD_NS + 'tab'
+_W_BR = _WORD_NS + 'br'
+_W_CR = _WORD_NS + 'cr'
+_W_TR = _WORD_NS + 'tr'
+_W_TC = _WORD_NS + 'tc'
+
+
+def _part_number(name):
+    match = re.search(r'(\d+)\.xml$', name)
+    return int(match.group(1)) if match else 0
+
+
+def _iter_docx_part(stream):
+    """
+    Yield the text lines of one WordprocessingML part (document, header or footer).
+
+    Paragraphs are yielded as they close; a paragraph nested in another (in
+    a text box) becomes a line of its own. Table rows are yielded as one line
+    with their cells separated by " | "; a table nested in a cell becomes part
+    of that cell's text. Only tabs inside runs become "\t" (tab stops in the
+    paragraph properties are layout). Finished paragraphs and tables are
+    cleared and detached from the top of the tree, so memory stays flat
+    however long the document is.
+    """
+    open_elements = []  # Elements started but not ended yet, root first
+    paragraphs = []     # Text of the paragraphs currently open, innermost last
+    rows = []           # Cells of the table rows currently open, innermost last
+    cells = []          # Paragraphs of the table cells currently open, innermost last
+    for event, elem in iterparse(stream, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            open_elements.append(elem)
+            if tag == _W_P:
+                paragraphs.append([])
+            elif tag == _W_TR:
+                rows.append([])
+            elif tag == _W_TC:
+                cells.append([])
+            continue
+
+        open_elements.pop()
+        parent = open_elements[-1] if open_elements else None
+        in_run = parent is not None and parent.tag == _W_R
+        if tag == _W_T:
+            if paragraphs:
+                paragraphs[-1].append(elem.text or '')
+        elif tag == _W_TAB:
+            if paragraphs and in_run:
+                paragraphs[-1].append('\t')
+        elif tag in (_W_BR, _W_CR):
+            if paragraphs and in_run:
+                paragraphs[-1].append('\n')
+        elif tag == _W_P:
+            text = ''.join(paragraphs.pop())
+            if cells:
+                if text:
+                    cells[-1].append(text)
+            else:
+                yield text
+            elem.clear()
+        elif tag == _W_TC:
+            rows[-1].append(' '.join(cells.pop()))
+            elem.clear()
+        elif tag == _W_TR:
+            row = ' | '.join(rows.pop())
+            if cells:
+                cells[-1].append(row)
+            else:
+                yield row
+            elem.clear()
+
+        if parent is not None and (parent is open_elements[0] or parent.tag == _W_BODY):
+            # A finished top-level block is never looked at again
+            parent.remove(elem)
+
+
+def iter_docx_text(stream):
+    """
+    Yield the text of a .docx file line by line without building a document model.
+
+    The package's XML parts are parsed incrementally straight from the zip:
+    headers first, then the body (paragraphs and tables in document order),
+    then footers.
+    """
+    with zipfile.ZipFile(stream) as package:
+        names = package.namelist()
+        headers = sorted((n for n in names if re.match(r'word/header\d*\.xml$', n)), key=_part_number)
+        footers = sorted((n for n in names if re.match(r'word/footer\d*\.xml$', n)), key=_part_number)
+        for name in headers + ['word/document.xml'] + footers:
+            with package.open(name) as part:
+                for line in _iter_docx_part(part):
+                    # Keep the body's blank lines (they separate sections) but not those of headers and footers
+                    if line or name == 'word/document.xml':
+                        yield line
+
+
+def extract_docx_text(upload):
+    """Return the text of a Word document (headers, body, tables and footers), one paragraph per line."""
+    with upload.open() as stream:
+        return "\n".join(iter_docx_text(stream))
+
+
+def extract_plain_text(upload):
+    """Decode a text-based file as UTF-8, dropping undecodable bytes."""
+    return upload.getvalue().decode('utf-8', errors='ignore')
+
+
+class ExtractionCache:
+    """
+    Content-addressed cache of extracted document text.
+
+    Entries are keyed by the SHA-256 of the decoded file bytes plus the format,
+    so the same document uploaded twice (e.g. token analysis followed by
+    generation) is only extracted once. `memory` is any mapping with get() and
+    item assignment (normally a SessionStore, which bounds it as an LRU); when
+    `disk_dir` is set, entries are also written there as JSON files and
+    survive restarts. Disk entries older than `disk_ttl` seconds are ignored
+    and removed when read.
+    """
+    def __init__(self, memory=None, disk_dir=None, disk_ttl=7 * 24 * 3600):
+        self.memory = memory if memory is not None else {}
+        self.disk_dir = disk_dir
+        self.disk_ttl = disk_ttl
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(upload, label):
+        return f"{label}:{upload.sha256()}"
+
+    def _disk_path(self, key):
+        label, digest = key.split(':', 1)
+        return os.path.join(self.disk_dir, f"{digest}.{label.replace(' ', '_').lower()}.json")
+
+    def get(self, key):
+        """Return the cached entry ({text, file_type, bytes, chars, extracted_at}) or None."""
+        entry = self.memory.get(key)
+        if entry is not None or not self.disk_dir:
+            return entry
+        path = self._disk_path(key)
+        try:
+            if self.disk_ttl is not None and time.time() - os.path.getmtime(path) > self.disk_ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable extraction cache file {path}: {str(e)}")
+            return None
+        self.memory[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        self.memory[key] = entry
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            # Write to a temporary file first so readers never see a partial entry
+            fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write extraction cache file {path}: {str(e)}")
+
+
+class DocumentExtractor:
+    """
+    Registry of format handlers that turn uploaded file bytes into text.
+
+    Handlers are looked up by file extension and receive the raw bytes; every
+    endpoint goes through extract() so improvements to a handler apply to all
+    of them. Unknown extensions are treated as text. With a cache, documents
+    that were already extracted are served from it.
+    """
+    def __init__(self, pdf_extractor=None, cache=None, spill_threshold=DEFAULT_SPILL_THRESHOLD):
+        self.cache = cache
+        self.spill_threshold = spill_threshold
+        self._handlers = {}
+        self._default = ("text file", extract_plain_text)
+        pdf_extractor = pdf_extractor or PdfExtractor()
+        self.register(['pdf'], pdf_extractor.extract_text, "PDF")
+        self.register(['docx', 'doc'], extract_docx_text, "Word document")
+
+    def register(self, extensions, handler, label):
+        """Use handler(upload) -> str for the given extensions; label names the format in errors."""
+        for extension in extensions:
+            self._handlers[extension.lower()] = (label, handler)
+
+    def is_binary(self, file_type):
+        """Whether content of this type is sent base64 encoded (anything with a dedicated handler)."""
+        return file_type.lower() in self._handlers
+
+    def extract(self, upload, file_type):
+        """Return the text of a document given its content (UploadBuffer or bytes) and extension."""
+        return self.extract_entry(upload, file_type)['text']
+
+    def extract_entry(self, upload, file_type):
+        """Return the extracted text with its metadata, using the cache when there is one."""
+        if not isinstance(upload, UploadBuffer):
+            upload = UploadBuffer.from_bytes(upload, spill_threshold=self.spill_threshold)
+        label, handler = self._handlers.get(file_type.lower(), self._default)
+        key = None
+        # Plain text is cheaper to decode again than to keep a second copy of
+        if self.cache is not None and self.is_binary(file_type):
+            key = ExtractionCache.key(upload, label)
+            entry = self.cache.get(key)
+            if entry is not None:
+                logger.info(f"Extraction cache hit for {label} ({len(upload)} bytes)")
+                return entry
+
+        try:
+            text = handler(upload)
+        except Exception as e:
+            raise DocumentExtractionError(f"Error processing {label}: {str(e)}") from e
+
+        entry = {
+            'text': text,
+            'file_type': file_type.lower(),
+            'bytes': len(upload),
+            'chars': len(text),
+            'extracted_at': time.time()
+        }
+        if key is not None:
+            self.cache.put(key, entry)
+        return entry
+
+    def extract_base64(self, encoded, file_type):
+        """Decode base64 content and return its text; any spilled temporary file is removed afterwards."""
+        with decode_upload(encoded, self.spill_threshold) as upload:
+            return self.extract(upload, file_type)
+
+    def extract_upload(self, file_name, encoded):
+        """Decode a base64 upload and return its text, picking the handler from the file name."""
+        return self.extract_base64(encoded, file_type_from_name(file_name))
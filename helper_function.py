@@ -8,6 +8,9 @@ import uuid
 import base64
 import traceback
 
+from client_pool import ClientPool, InvalidAPIKeyError, KeyVerifier, create_http_session, create_shared_http_client
+from retry_policy import ERROR_TYPE_STATUSES, UPSTREAM_RETRY_POLICY, retry_after_seconds
+
 # Import Google Generative AI package
 try:
     import google.generativeai as genai
@@ -16,27 +19,24 @@ except ImportError:
     GEMINI_AVAILABLE = False
     print("Google Generative AI package not available. Some features may be limited.")
 
-def create_anthropic_client(api_key):
-    """Create an Anthropic client with the given API key."""
-    print(f"Creating Anthropic client with API key: {api_key[:8]}...")
-    
-    # Check if API key is valid format
-    if not api_key or not api_key.strip():
-        raise ValueError("API key cannot be empty")
-    
-    # Try to create the client with the standard approach first
+# Anthropic clients are reused per API key and share one HTTP connection pool
+ANTHROPIC_CLIENT_IDLE_TTL = 600  # Seconds an unused client is kept
+ANTHROPIC_CLIENT_MAX = 64  # Clients kept at most (least recently used are dropped)
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 20))  # Keep-alive connections per pool (also used by VercelCompatibleClient)
+shared_http_client = create_shared_http_client(max_keepalive_connections=HTTP_POOL_MAXSIZE)
+
+def _build_anthropic_client(api_key):
+    """Build a new Anthropic client, falling back to VercelCompatibleClient if the SDK fails."""
+    # Try to create the client with the standard approach first.
+    # The SDK's own retries are off: calls retry under UPSTREAM_RETRY_POLICY only.
     try:
-        # Create client with only the essential parameter
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        # Test a simple call to verify the client works
-        try:
-            # Try a simple call that doesn't cost tokens
-            client.count_tokens("Test")
-            return client
-        except Exception as e:
-            print(f"Warning: Token counting failed but client might still work: {str(e)}")
-            return client
+        if shared_http_client is not None:
+            try:
+                return anthropic.Anthropic(api_key=api_key, max_retries=0, http_client=shared_http_client)
+            except TypeError:
+                # SDK versions without the http_client option
+                pass
+        return anthropic.Anthropic(api_key=api_key, max_retries=0)
             
     except Exception as e:
         print(f"Standard client creation failed: {str(e)}")
@@ -49,6 +49,56 @@ def create_anthropic_client(api_key):
             print(f"Custom client also failed: {str(e2)}")
             raise Exception(f"Failed to create Anthropic client: {str(e)}")
 
+anthropic_client_pool = ClientPool(
+    _build_anthropic_client,
+    idle_ttl=ANTHROPIC_CLIENT_IDLE_TTL,
+    max_clients=ANTHROPIC_CLIENT_MAX,
+    name="anthropic-clients"
+)
+
+def create_anthropic_client(api_key):
+    """Return the Anthropic client for the given API key, reusing a pooled one when possible."""
+    # Check if API key is valid format
+    if not api_key or not api_key.strip():
+        raise ValueError("API key cannot be empty")
+    
+    # No probe request here: a bad key fails on the first real call
+    return anthropic_client_pool.get(api_key)
+
+# Keys are checked with the provider before anything is served without calling it (cached or
+# shared generations); accepted keys are remembered so the check costs one request per key
+API_KEY_VERIFY_TTL = 600
+key_check_session = create_http_session(pool_size=4)
+
+def _check_anthropic_key(api_key):
+    """Ask the Anthropic API whether it accepts api_key (listing models costs no tokens)."""
+    response = key_check_session.get(
+        "https://api.anthropic.com/v1/models",
+        headers={"x-api-key": api_key, "anthropic-version": "2023-06-01"},
+        timeout=10
+    )
+    if response.status_code in (401, 403):
+        return False
+    if response.status_code != 200:
+        raise Exception(f"Could not verify the API key (HTTP {response.status_code})")
+    return True
+
+def _check_gemini_key(api_key):
+    """Ask the Gemini API whether it accepts api_key."""
+    response = key_check_session.get(
+        "https://generativelanguage.googleapis.com/v1beta/models",
+        params={"key": api_key, "pageSize": 1},
+        timeout=10
+    )
+    if response.status_code in (400, 401, 403):
+        return False
+    if response.status_code != 200:
+        raise Exception(f"Could not verify the API key (HTTP {response.status_code})")
+    return True
+
+anthropic_key_verifier = KeyVerifier(_check_anthropic_key, ttl=API_KEY_VERIFY_TTL, name="anthropic-keys")
+gemini_key_verifier = KeyVerifier(_check_gemini_key, ttl=API_KEY_VERIFY_TTL, name="gemini-keys")
+
 def create_gemini_client(api_key):
     """Create a Google Gemini client with the given API key."""
     if not GEMINI_AVAILABLE:
@@ -89,9 +139,11 @@ class GeminiStreamingResponse:
     Custom class to handle streaming responses from Google Gemini API.
     Provides compatibility with the server-sent events format used by the frontend.
     """
-    def __init__(self, stream_response, session_id):
+    def __init__(self, stream_response, session_id, token_counter=None, prompt=None):
         self.stream_response = stream_response
         self.session_id = session_id
+        self.token_counter = token_counter
+        self.prompt = prompt
         self.text_chunks = []
         self.message_id = str(uuid.uuid4())
         self.chunk_count = 0
@@ -101,6 +153,12 @@ class GeminiStreamingResponse:
         self.timeout = 300  # Maximum time to wait for first chunk (seconds)
         self.progress_timeout = 100  # Maximum time to wait between chunks (seconds)
         self.response_complete = False
+
+    def count_tokens(self, text):
+        """Token count of text with the server's counter, or a rough len // 4 without one."""
+        if self.token_counter is not None:
+            return self.token_counter.count(text, 'gemini')
+        return len(text) // 4
         
     def __enter__(self):
         return self
@@ -227,12 +285,8 @@ class GeminiStreamingResponse:
             self.response_complete = True
             
             # Calculate token usage (approximate)
-            input_prompt_length = 1000  # Placeholder
-            output_length = len(self.accumulated_text)
-            
-            # Estimate token count (very rough estimate)
-            input_tokens = input_prompt_length // 4
-            output_tokens = output_length // 4
+            input_tokens = self.count_tokens(self.prompt) if self.prompt else 250  # Placeholder without a prompt
+            output_tokens = self.count_tokens(self.accumulated_text)
             
             # Create completion event
             complete_data = {
@@ -260,6 +314,8 @@ class GeminiStreamingResponse:
             # If we have any accumulated content, we'll mark as complete to return what we have
             if self.accumulated_text:
                 self.response_complete = True
+                input_tokens = self.count_tokens(self.prompt) if self.prompt else 1000  # Placeholder estimate without a prompt
+                output_tokens = self.count_tokens(self.accumulated_text)
                 print(f"Returning partial accumulated content ({len(self.accumulated_text)} chars)")
                 
                 # Send completion with partial content
@@ -268,9 +324,9 @@ class GeminiStreamingResponse:
                     "message_id": self.message_id,
                     "chunk_id": f"{self.message_id}_{self.chunk_count}",
                     "usage": {
-                        "input_tokens": 1000,  # Placeholder estimate
-                        "output_tokens": len(self.accumulated_text) // 4,
-                        "total_tokens": 1000 + (len(self.accumulated_text) // 4)
+                        "input_tokens": input_tokens,
+                        "output_tokens": output_tokens,
+                        "total_tokens": input_tokens + output_tokens
                     },
                     "html": self.accumulated_text,
                     "session_id": self.session_id,
@@ -291,7 +347,7 @@ class GeminiStreamingResponse:
 
 # Special client class for Vercel that doesn't use the standard Anthropic library
 class VercelCompatibleClient:
-    def __init__(self, api_key):
+    def __init__(self, api_key, pool_size=HTTP_POOL_MAXSIZE, retry_policy=UPSTREAM_RETRY_POLICY):
         self.api_key = api_key
         self.base_url = "https://api.anthropic.com/v1"
         self.headers = {
@@ -299,6 +355,9 @@ class VercelCompatibleClient:
             "anthropic-version": "2023-06-01",
             "content-type": "application/json"
         }
+        # Keep-alive connection pool reused by every call of this client
+        self.session = create_http_session(pool_size=pool_size)
+        self.retry_policy = retry_policy
         
         # Add beta and messages namespaces for compatibility
         self.beta = self._BetaNamespace(self)
@@ -310,7 +369,7 @@ class VercelCompatibleClient:
         if headers:
             _headers.update(headers)
         
-        response = requests.post(
+        response = self.session.post(
             url,
             json=json,
             headers=_headers,
@@ -325,7 +384,7 @@ class VercelCompatibleClient:
                 self.client = client
                 
             def list(self):
-                response = requests.get(
+                response = self.client.session.get(
                     f"{self.client.base_url}/models",
                     headers=self.client.headers
                 )
@@ -433,97 +492,65 @@ class VercelCompatibleClient:
                     # For local environment, use a longer timeout
                     timeout = 30
                 
-                # Implement retry logic with exponential backoff
-                max_retries = 5
-                retry_count = 0
-                base_delay = 2  # Start with a 2-second delay
+                # Retry transient failures under the shared retry policy
+                retry = self.client.retry_policy.start()
                 
-                while retry_count < max_retries:
+                while True:
                     try:
                         # Make the API request to stream response
-                        stream_response = requests.post(
+                        stream_response = self.client.session.post(
                             f"{self.client.base_url}/messages",
                             headers=headers,
                             json=payload,
                             stream=True,
                             timeout=timeout
                         )
-                        
-                        if stream_response.status_code not in [200, 201]:
-                            error_msg = None
-                            # Handle error responses with retry logic
-                            if stream_response.status_code == 529:  # Overloaded
-                                retry_count += 1
-                                retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                                print(f"API overloaded (529), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                                time.sleep(retry_delay)
-                                continue
-                            elif stream_response.status_code == 500:  # Internal server error
-                                retry_count += 1
-                                retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                                print(f"API internal error (500), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                                time.sleep(retry_delay)
-                                continue
-                            elif stream_response.status_code == 408:  # Timeout
-                                retry_count += 1
-                                retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                                print(f"API timeout (408), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                                time.sleep(retry_delay)
-                                continue
-                            
-                            # If not a retriable error or we couldn't extract an error message
-                            try:
-                                error_text = next(stream_response.iter_lines()).decode('utf-8')
-                                if error_text.startswith('data: '):
-                                    error_json = json.loads(error_text[6:])
-                                    error_msg = error_json.get('error', {}).get('message', error_text)
-                                else:
-                                    error_msg = error_text
-                            except Exception:
-                                error_msg = f"HTTP Error {stream_response.status_code}"
-                            
-                            raise Exception(f"API request failed: {error_msg}")
-                        
+                    except requests.exceptions.Timeout:
+                        delay = retry.next_delay()
+                        if delay is None:
+                            # On Vercel, tell the client which session to continue with
+                            if is_vercel:
+                                raise Exception(f"Vercel timeout after {retry.retries} retries - client should continue with session: {session_id}")
+                            raise Exception(f"Request timed out after {retry.retries} retries")
+                        print(f"Request timed out, retrying in {delay:.1f} seconds (retry {retry.retries})")
+                        time.sleep(delay)
+                        continue
+                    except requests.exceptions.ConnectionError as e:
+                        delay = retry.next_delay()
+                        if delay is None:
+                            raise Exception(f"Connection error after {retry.retries} retries: {str(e)}")
+                        print(f"Connection error, retrying in {delay:.1f} seconds (retry {retry.retries})")
+                        time.sleep(delay)
+                        continue
+                    
+                    if stream_response.status_code in [200, 201]:
                         # Return a streaming response wrapper that mimics the Anthropic client
                         # Add the session_id and is_vercel flags to help with timeout handling
                         return VercelStreamingResponse(stream_response, self.client, 
                                                      session_id=session_id,
                                                      is_vercel=is_vercel)
-                        
-                    except requests.exceptions.Timeout:
-                        # If timeout occurs on Vercel, provide information for client reconnection
-                        if is_vercel:
-                            retry_count += 1
-                            if retry_count >= max_retries:
-                                raise Exception(f"Vercel timeout after {max_retries} retries - client should continue with session: {session_id}")
-                            retry_delay = base_delay * (2 ** retry_count)
-                            print(f"Vercel timeout, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                            time.sleep(retry_delay)
-                            continue
-                        else:
-                            retry_count += 1
-                            if retry_count >= max_retries:
-                                raise Exception(f"Request timed out after {max_retries} retries")
-                            retry_delay = base_delay * (2 ** retry_count)
-                            print(f"Request timed out, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                            time.sleep(retry_delay)
-                            continue
-                            
-                    except Exception as e:
-                        # For network/connection errors, retry
-                        if "connection" in str(e).lower() or "timeout" in str(e).lower():
-                            retry_count += 1
-                            if retry_count >= max_retries:
-                                raise Exception(f"Connection error after {max_retries} retries: {str(e)}")
-                            retry_delay = base_delay * (2 ** retry_count)
-                            print(f"Connection error, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                            time.sleep(retry_delay)
-                            continue
+                    
+                    # Retryable statuses (408, 429, 500, 502-504, 529) wait as the policy says
+                    delay = retry.next_delay(stream_response.status_code, retry_after_seconds(stream_response.headers))
+                    if delay is not None:
+                        print(f"API returned {stream_response.status_code}, retrying in {delay:.1f} seconds (retry {retry.retries})")
+                        stream_response.close()  # Return the connection to the pool
+                        time.sleep(delay)
+                        continue
+                    
+                    # Not retryable, or out of retries: report the API's error message
+                    try:
+                        error_text = next(stream_response.iter_lines()).decode('utf-8')
+                        if error_text.startswith('data: '):
+                            error_json = json.loads(error_text[6:])
+                            error_msg = error_json.get('error', {}).get('message', error_text)
                         else:
-                            raise Exception(f"API request failed: {str(e)}")
-                
-                # If we've exhausted all retries
-                raise Exception(f"API request failed after {max_retries} retries")
+                            error_msg = error_text
+                    except Exception:
+                        error_msg = f"HTTP Error {stream_response.status_code}"
+                    stream_response.close()
+                    
+                    raise Exception(f"API request failed: {error_msg}")
     
     # Regular messages namespace
     class _MessagesNamespace:
@@ -594,83 +621,69 @@ class VercelCompatibleClient:
             elif betas and isinstance(betas, list) and len(betas) > 0:
                 headers["anthropic-beta"] = ",".join(betas)
             
-            # Implement retry logic with exponential backoff
-            max_retries = 5
-            retry_count = 0
-            base_delay = 2  # Start with a 2-second delay
+            # Retry transient failures under the shared retry policy
+            retry = self.client.retry_policy.start()
             
-            while retry_count < max_retries:
+            while True:
                 try:
                     # Make the API request with a longer timeout for large requests
-                    response = requests.post(
+                    response = self.client.session.post(
                         f"{self.client.base_url}/messages",
                         headers=headers,
                         json=payload,
                         timeout=600  # 10 minutes timeout for large requests
                     )
-                    
-                    # Check if we received a successful response
-                    if response.status_code == 200:
-                        # Parse the result
-                        result = response.json()
-                        
-                        # Return a response wrapper that mimics the Anthropic client
-                        return VercelMessageResponse(result)
-                        
-                    # Handle specific error codes with retries
-                    elif response.status_code == 529:  # Overloaded
-                        retry_count += 1
-                        retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                        print(f"API overloaded (529), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                        time.sleep(retry_delay)
-                        continue
-                        
-                    elif response.status_code == 500:  # Internal server error
-                        retry_count += 1
-                        retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                        print(f"API internal error (500), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                        time.sleep(retry_delay)
-                        continue
-                        
-                    elif response.status_code == 408:  # Timeout
-                        retry_count += 1
-                        retry_delay = base_delay * (2 ** retry_count)  # Exponential backoff
-                        print(f"API timeout (408), retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                        time.sleep(retry_delay)
-                        continue
-                    
-                    else:
-                        # Try to get detailed error message
-                        try:
-                            error_json = response.json()
-                            error_msg = error_json.get('error', {}).get('message', f"HTTP {response.status_code}")
-                        except Exception:
-                            error_msg = f"HTTP Error {response.status_code}: {response.text[:100]}"
-                        
-                        raise Exception(f"API request failed: {error_msg}")
-                        
                 except requests.exceptions.Timeout:
-                    retry_count += 1
-                    retry_delay = base_delay * (2 ** retry_count)
-                    print(f"Request timed out, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                    time.sleep(retry_delay)
+                    delay = retry.next_delay()
+                    if delay is None:
+                        raise Exception(f"Request timed out after {retry.retries} retries")
+                    print(f"Request timed out, retrying in {delay:.1f} seconds (retry {retry.retries})")
+                    time.sleep(delay)
                     continue
-                    
-                except Exception as e:
-                    # For other exceptions, retry a few times
-                    if "connection" in str(e).lower() or "timeout" in str(e).lower():
-                        retry_count += 1
-                        retry_delay = base_delay * (2 ** retry_count)
-                        print(f"Connection error, retrying in {retry_delay} seconds (attempt {retry_count}/{max_retries})")
-                        time.sleep(retry_delay)
-                        continue
-                    else:
-                        raise Exception(f"API request failed: {str(e)}")
-            
-            # If we've exhausted all retries
-            raise Exception(f"API request failed after {max_retries} retries")
+                except requests.exceptions.ConnectionError as e:
+                    delay = retry.next_delay()
+                    if delay is None:
+                        raise Exception(f"Connection error after {retry.retries} retries: {str(e)}")
+                    print(f"Connection error, retrying in {delay:.1f} seconds (retry {retry.retries})")
+                    time.sleep(delay)
+                    continue
+                
+                # Check if we received a successful response
+                if response.status_code == 200:
+                    # Return a response wrapper that mimics the Anthropic client
+                    return VercelMessageResponse(response.json())
+                
+                # Retryable statuses (408, 429, 500, 502-504, 529) wait as the policy says
+                delay = retry.next_delay(response.status_code, retry_after_seconds(response.headers))
+                if delay is not None:
+                    print(f"API returned {response.status_code}, retrying in {delay:.1f} seconds (retry {retry.retries})")
+                    time.sleep(delay)
+                    continue
+                
+                # Try to get detailed error message
+                try:
+                    error_json = response.json()
+                    error_msg = error_json.get('error', {}).get('message', f"HTTP {response.status_code}")
+                except Exception:
+                    error_msg = f"HTTP Error {response.status_code}: {response.text[:100]}"
+                
+                raise Exception(f"API request failed: {error_msg}")
 
 # Wrapper for the streaming response
+class VercelStreamError(Exception):
+    """
+    An error event received in the middle of a streamed response.
+
+    Carries the event's body and the HTTP status of its error type, so the
+    retry policy treats e.g. an overloaded stream like a 529 response.
+    """
+    def __init__(self, body):
+        error = body.get('error', {}) if isinstance(body, dict) else {}
+        super().__init__(error.get('message', 'Stream error'))
+        self.body = body
+        self.status_code = ERROR_TYPE_STATUSES.get(error.get('type'))
+
+
 class VercelStreamingResponse:
     def __init__(self, stream_response, client, session_id=None, is_vercel=False):
         self.stream_response = stream_response
@@ -681,12 +694,48 @@ class VercelStreamingResponse:
         self.buffer = []
         self.buffer_limit = 10  # Maximum number of chunks to buffer
         self.last_error = None
+        # Token counts reported by the message_start and message_delta events
+        self.usage = self._UsageInfo(0, 0, 0)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        # Release the pooled connection even if the stream wasn't read to the end
+        self.stream_response.close()
+
+    def get_final_message(self):
+        """Return the finished message like the SDK's message streams do (only id and usage are filled in)."""
+        return type('FinalMessage', (), {"id": self.session_id, "usage": self.usage})
+
+    def _events(self):
+        """Parse the server-sent events of the response into delta chunks, recording usage on the way."""
+        for line in self.stream_response.iter_lines():
+            if not line:
+                continue
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if not line.startswith('data: '):
+                continue
+            try:
+                event = json.loads(line[6:])
+            except ValueError:
+                continue
+            event_type = event.get('type')
+            if event_type == 'message_start':
+                usage = event.get('message', {}).get('usage', {})
+                self.usage.input_tokens = usage.get('input_tokens', 0)
+                self.usage.output_tokens = usage.get('output_tokens', 0)
+            elif event_type == 'message_delta':
+                self.usage.output_tokens = event.get('usage', {}).get('output_tokens', self.usage.output_tokens)
+            elif event_type == 'content_block_delta':
+                delta = event.get('delta', {})
+                if delta.get('type') == 'text_delta':
+                    yield self._ContentDeltaChunk(delta.get('text', ''))
+                elif delta.get('type') == 'thinking_delta':
+                    yield self._ThinkingUpdateChunk(self._ThinkingObject(delta.get('thinking', '')))
+            elif event_type == 'error':
+                raise VercelStreamError(event)
 
     def __iter__(self):
         # Keep track of the total output size
@@ -700,7 +749,7 @@ class VercelStreamingResponse:
             # Stream begins event
             yield self._ChunkObject("stream_start")
             
-            for chunk in self.stream_response:
+            for chunk in self._events():
                 try:
                     self.chunk_count += 1
                     
@@ -754,14 +803,7 @@ class VercelStreamingResponse:
             # Stream completed successfully
             # Create a completion object with usage statistics
             # This is important for large content to know when it's complete
-            usage_info = None
-            if hasattr(self.stream_response, 'usage'):
-                usage_obj = self.stream_response.usage
-                usage_info = self._UsageInfo(
-                    getattr(usage_obj, 'input_tokens', 0),
-                    getattr(usage_obj, 'output_tokens', 0),
-                    getattr(usage_obj, 'thinking_tokens', 0)
-                )
+            usage_info = self.usage if self.usage.input_tokens else None
             
             # Create a completion message
             completion = {
@@ -786,11 +828,9 @@ class VercelStreamingResponse:
             yield end_event_obj
             
         except Exception as e:
-            # If there's a terminal error, send an error message
+            # Raise terminal errors to the caller: a stream cut short must not look complete
             print(f"Stream error: {str(e)}")
-            error_obj = self._ErrorChunk(str(e))
-            error_obj.session_id = self.session_id
-            yield error_obj
+            raise
 
     def _add_to_buffer(self, chunk):
         """Add a chunk to the reconnection buffer, maintaining max buffer size"""
@@ -847,11 +887,6 @@ class VercelStreamingResponse:
             self.session_id = session_id
             self.chunk_count = chunk_count
     
-    class _ErrorChunk:
-        def __init__(self, error_message):
-            self.type = 'error'
-            self.error = error_message
-    
     class _UsageInfo:
         def __init__(self, input_tokens, output_tokens, thinking_tokens):
             self.input_tokens = input_tokens
@@ -0,0 +1,149 @@
+# Retry and backoff policy shared by every upstream API call
+import os
+import random
+import time
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+
+# How a retryable status is handled: at most `max_retries` retries for it
+# (None: the policy's limit) and never sooner than `min_delay` seconds
+StatusRule = namedtuple('StatusRule', ['max_retries', 'min_delay'])
+
+DEFAULT_STATUS_RULES = {
+    408: StatusRule(max_retries=3, min_delay=0.0),     # Request timeout
+    429: StatusRule(max_retries=None, min_delay=1.0),  # Rate limited; Retry-After usually says how long
+    500: StatusRule(max_retries=3, min_delay=0.0),     # Internal error, rarely fixed by waiting long
+    502: StatusRule(max_retries=3, min_delay=0.0),     # Bad gateway (a proxy or the API gateway in front)
+    503: StatusRule(max_retries=None, min_delay=1.0),  # Unavailable; like 429, may send Retry-After
+    504: StatusRule(max_retries=3, min_delay=0.0),     # Gateway timeout
+    529: StatusRule(max_retries=None, min_delay=2.0),  # Overloaded
+    None: StatusRule(max_retries=3, min_delay=0.0),    # Connection errors, timeouts, empty responses
+}
+
+# HTTP statuses of the error types the Anthropic API reports; an error event inside
+# a stream arrives on a response whose status is still 200
+ERROR_TYPE_STATUSES = {
+    'invalid_request_error': 400,
+    'authentication_error': 401,
+    'permission_error': 403,
+    'not_found_error': 404,
+    'request_too_large': 413,
+    'rate_limit_error': 429,
+    'api_error': 500,
+    'overloaded_error': 529,
+}
+
+
+def retry_after_seconds(headers):
+    """Return the delay a Retry-After header asks for (seconds or an HTTP date), or None."""
+    value = headers.get('retry-after') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def error_status(error):
+    """
+    Return the HTTP status of an API error, 529 for overload errors without one, or None.
+
+    Understands the Anthropic SDK's errors (status_code or response) and the
+    error messages raised by VercelCompatibleClient. Errors raised for an
+    error event in the middle of a stream get the status of their error type.
+    """
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    body = getattr(error, 'body', None)
+    error_type = body.get('error', {}).get('type') if isinstance(body, dict) else None
+    if error_type in ERROR_TYPE_STATUSES and status in (None, 200):
+        return ERROR_TYPE_STATUSES[error_type]
+    if isinstance(status, int):
+        return status
+    if 'overloaded' in str(error).lower():
+        return 529
+    return None
+
+
+def error_retry_after(error):
+    """Return the Retry-After delay attached to an API error's response, or None."""
+    return retry_after_seconds(getattr(getattr(error, 'response', None), 'headers', None))
+
+
+class RetryPolicy:
+    """
+    When and how long to wait before retrying an upstream call.
+
+    Delays use decorrelated jitter: each one is drawn between `base_delay`
+    and three times the previous delay, capped at `max_delay`, so concurrent
+    clients spread out instead of retrying in lockstep. A Retry-After from the
+    server is honored as a lower bound. Each status follows its StatusRule and
+    a call gives up after `max_retries` retries or once the next wait would
+    end past `deadline` seconds from its first attempt.
+    """
+    def __init__(self, base_delay=1.0, max_delay=45.0, max_retries=10, deadline=600.0, status_rules=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.status_rules = dict(DEFAULT_STATUS_RULES if status_rules is None else status_rules)
+
+    def start(self):
+        """Begin tracking the retries of one call."""
+        return RetryState(self)
+
+
+class RetryState:
+    """Retries made so far by one call under a RetryPolicy."""
+    def __init__(self, policy):
+        self.policy = policy
+        self.started_at = time.time()
+        self.retries = 0
+        self.last_delay = policy.base_delay
+        self._per_status = {}
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    def next_delay(self, status=None, retry_after=None):
+        """
+        Record a failed attempt and return how long to wait before the next one.
+
+        Returns None when the call should give up: the status isn't retryable,
+        its retries are used up, or waiting would overrun the deadline.
+        """
+        policy = self.policy
+        rule = policy.status_rules.get(status)
+        if rule is None:
+            return None
+        status_retries = self._per_status.get(status, 0)
+        if self.retries >= policy.max_retries:
+            return None
+        if rule.max_retries is not None and status_retries >= rule.max_retries:
+            return None
+
+        delay = min(policy.max_delay, random.uniform(policy.base_delay, self.last_delay * 3))
+        delay = max(delay, rule.min_delay, retry_after or 0.0)
+        if policy.deadline is not None and self.elapsed + delay > policy.deadline:
+            return None
+
+        self.retries += 1
+        self._per_status[status] = status_retries + 1
+        self.last_delay = delay
+        return delay
+
+
+# Policy used for calls to the Anthropic API, tunable through the environment
+UPSTREAM_RETRY_POLICY = RetryPolicy(
+    base_delay=float(os.environ.get('RETRY_BASE_DELAY', 1.0)),
+    max_delay=float(os.environ.get('RETRY_MAX_DELAY', 45.0)),
+    max_retries=int(os.environ.get('RETRY_MAX_RETRIES', 10)),
+    deadline=float(os.environ.get('RETRY_DEADLINE', 600.0))
+)
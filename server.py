@@ -1,8 +1,16 @@
 import threading
 
-from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory
+from flask import Flask, Request, request, jsonify, Response, stream_with_context, send_from_directory
 from flask_cors import CORS
-from helper_function import create_anthropic_client, create_gemini_client, GeminiStreamingResponse
+from helper_function import create_anthropic_client, create_gemini_client, GeminiStreamingResponse, InvalidAPIKeyError, anthropic_key_verifier, gemini_key_verifier
+from stream_buffers import OutputBuffer, SegmentLog, StreamEventLog
+from session_store import SessionStore, create_session_backend
+from background_jobs import JobExecutor, QueueFullError
+from stream_progress import StreamProgressLogger, write_debug_artifact
+from token_counter import TokenCounter
+from retry_policy import UPSTREAM_RETRY_POLICY, error_status, error_retry_after
+from chunked_uploads import ChunkedUploadStaging, UploadNotFoundError, ChunkOffsetError
+from document_extraction import PdfExtractor, DocumentExtractor, DocumentExtractionError, ExtractionCache, UploadBuffer, decode_upload, file_type_from_name
 import anthropic
 import json
 import os
@@ -20,12 +28,10 @@ except ImportError:
     TextBlock = dict
     MessageParam = dict
 import uuid
-import PyPDF2
-import docx
-import io
 import base64
-import random 
+import hashlib
 import socket
+import tempfile
 import argparse
 import logging
 from datetime import datetime
@@ -52,12 +58,130 @@ CORS(app)  # Enable CORS for all routes
 app.config['TIMEOUT'] = 1800  # 30 minutes timeout
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB max content size
 
-#
-result_cache = {}
-
-# Simple in-memory session cache (for production, consider Redis)
-session_cache = {}
+# Gemini background job records ({state, progress, html, error, timestamps}), keyed by task uuid
+RESULT_CACHE_EXPIRY = 30 * 60  # Unfetched results are dropped 30 minutes after the job finished
+RESULT_CACHE_MAX_ENTRIES = 1000
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # Least recently used results are evicted beyond this
+RESULT_CACHE_DELETE_ON_FETCH = False  # Default for the 'consume' flag of /api/process-gemini-result
+result_cache = SessionStore(
+    ttl=RESULT_CACHE_EXPIRY,
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_BYTES,
+    name="result-cache",
+    # Queued and running jobs are kept however long they take; only finished ones expire
+    pinned=lambda job: job.get('state') in ('queued', 'running')
+)
+
+# Gemini background jobs run on a bounded pool instead of one thread per request
+GEMINI_MAX_WORKERS = int(os.environ.get('GEMINI_MAX_WORKERS', 4))
+GEMINI_MAX_QUEUE = int(os.environ.get('GEMINI_MAX_QUEUE', 16))  # Jobs allowed to wait for a free worker
+GEMINI_RETRY_AFTER = 15  # Seconds clients are asked to wait when the queue is full
+GEMINI_RESULT_MAX_WAIT = 30  # Longest a /api/process-gemini-result long poll may block
+# Stream progress log verbosity: DEBUG logs every chunk, INFO periodic summaries, WARNING only failures
+STREAM_LOG_LEVEL = os.environ.get('STREAM_LOG_LEVEL', 'INFO').upper()
+logging.getLogger('stream_progress').setLevel(getattr(logging, STREAM_LOG_LEVEL, logging.INFO))
+# When set, the final HTML of each Gemini job is written to this directory for debugging
+GEMINI_DEBUG_ARTIFACT_DIR = os.environ.get('GEMINI_DEBUG_ARTIFACT_DIR')
+gemini_executor = JobExecutor(
+    max_workers=GEMINI_MAX_WORKERS,
+    max_queue=GEMINI_MAX_QUEUE,
+    name="gemini-job"
+)
+
+# In-memory session cache with TTL expiry and an LRU size budget (for production, consider Redis)
 SESSION_CACHE_EXPIRY = 3600  # 1 hour cache expiry
+SESSION_CACHE_MAX_ENTRIES = 500  # Least recently used sessions are evicted beyond this
+SESSION_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Approximate budget for cached content and generated HTML
+SESSION_CACHE_SWEEP_INTERVAL = 30  # Seconds between background expiry sweeps
+# Where resumable stream state is persisted: 'memory' (this process only) or 'sqlite'
+# (shared by all workers on the host and kept across restarts)
+SESSION_STORE_BACKEND = os.environ.get('SESSION_STORE_BACKEND', 'memory')
+SESSION_STORE_PATH = os.environ.get('SESSION_STORE_PATH', os.path.join(tempfile.gettempdir(), 'file_visualizer_sessions.db'))
+session_cache = SessionStore(
+    ttl=SESSION_CACHE_EXPIRY,
+    max_entries=SESSION_CACHE_MAX_ENTRIES,
+    max_bytes=SESSION_CACHE_MAX_BYTES,
+    sweep_interval=SESSION_CACHE_SWEEP_INTERVAL,
+    name="session-cache",
+    backend=create_session_backend(SESSION_STORE_BACKEND, SESSION_STORE_PATH),
+    # A session whose generation is still streaming is never evicted, so reconnects keep working
+    pinned=lambda session: bool(session.get('active'))
+)
+
+# PDFs with at least this many pages have their text extracted by a pool of worker processes
+PDF_PARALLEL_MIN_PAGES = 50
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', min(4, os.cpu_count() or 1)))
+pdf_extractor = PdfExtractor(
+    max_workers=PDF_EXTRACTION_WORKERS,
+    min_parallel_pages=PDF_PARALLEL_MIN_PAGES
+)
+# Extracted text keyed by the SHA-256 of the uploaded bytes, so re-sent documents aren't re-extracted
+EXTRACTION_CACHE_EXPIRY = 3600
+EXTRACTION_CACHE_MAX_ENTRIES = 200
+EXTRACTION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Optional directory for a persistent second tier of the extraction cache
+EXTRACTION_CACHE_DIR = os.environ.get('EXTRACTION_CACHE_DIR')
+extraction_cache = ExtractionCache(
+    memory=SessionStore(
+        ttl=EXTRACTION_CACHE_EXPIRY,
+        max_entries=EXTRACTION_CACHE_MAX_ENTRIES,
+        max_bytes=EXTRACTION_CACHE_MAX_BYTES,
+        name="extraction-cache"
+    ),
+    disk_dir=EXTRACTION_CACHE_DIR
+)
+# Decoded uploads above this size are held in an auto-deleted temporary file instead of memory
+UPLOAD_SPILL_THRESHOLD = 16 * 1024 * 1024
+# Turns uploaded files into text for every endpoint, picking a handler by file extension
+document_extractor = DocumentExtractor(
+    pdf_extractor=pdf_extractor,
+    cache=extraction_cache,
+    spill_threshold=UPLOAD_SPILL_THRESHOLD
+)
+
+# Documents uploaded once to /api/documents and referenced by document_id afterwards
+DOCUMENT_STORE_EXPIRY = 6 * 3600
+DOCUMENT_STORE_MAX_ENTRIES = 500
+DOCUMENT_STORE_MAX_BYTES = 512 * 1024 * 1024
+# Optional directory that keeps stored documents across restarts and shares them between workers
+DOCUMENT_STORE_DIR = os.environ.get('DOCUMENT_STORE_DIR')
+document_store = ExtractionCache(
+    memory=SessionStore(
+        ttl=DOCUMENT_STORE_EXPIRY,
+        max_entries=DOCUMENT_STORE_MAX_ENTRIES,
+        max_bytes=DOCUMENT_STORE_MAX_BYTES,
+        name="document-store"
+    ),
+    disk_dir=DOCUMENT_STORE_DIR,
+    disk_ttl=DOCUMENT_STORE_EXPIRY
+)
+
+# Chunked uploads are staged here until finalized (shared by workers when on a shared disk)
+UPLOAD_STAGING_DIR = os.environ.get('UPLOAD_STAGING_DIR', os.path.join(tempfile.gettempdir(), 'file_visualizer_uploads'))
+CHUNKED_UPLOAD_MAX_BYTES = 1024 * 1024 * 1024  # Largest file accepted through chunked uploads
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Chunk size suggested to clients
+CHUNKED_UPLOAD_EXPIRY = 24 * 3600  # Unfinished uploads without new chunks are removed after this
+upload_staging = ChunkedUploadStaging(
+    UPLOAD_STAGING_DIR,
+    max_bytes=CHUNKED_UPLOAD_MAX_BYTES,
+    ttl=CHUNKED_UPLOAD_EXPIRY
+)
+
+# Finished generations keyed by a hash of the content and every generation parameter, so
+# regenerating the same document with the same settings is served without calling the model
+GENERATION_CACHE_EXPIRY = 24 * 3600
+GENERATION_CACHE_MAX_ENTRIES = 200
+GENERATION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+generation_cache = SessionStore(
+    ttl=GENERATION_CACHE_EXPIRY,
+    max_entries=GENERATION_CACHE_MAX_ENTRIES,
+    max_bytes=GENERATION_CACHE_MAX_BYTES,
+    name="generation-cache"
+)
+# Generations running in this process, keyed by generation cache key: identical concurrent
+# requests subscribe to the running session instead of starting a second upstream stream
+inflight_generations = {}
+inflight_generations_lock = threading.Lock()
 
 # Claude 3.7 has a total context window of 200,000 tokens (input + output combined)
 # We'll use this constant when estimating token usage
@@ -67,10 +191,17 @@ TOTAL_CONTEXT_WINDOW = 200000
 # This should be dynamically adjusted based on requested max_tokens
 MAX_INPUT_TOKENS = 195000  # Setting a bit lower than the actual limit to account for system prompt and overhead
 
+# Document tokens sent to the model when streaming (about the 100k characters allowed before), to avoid timeouts
+STREAM_CONTENT_MAX_TOKENS = 28000
+# Requests whose max_tokens leaves less room than this for the document are rejected
+STREAM_CONTENT_MIN_TOKENS = 1000
+
+# Local token counts, calibrated against the usage the APIs report
+token_counter = TokenCounter()
+
 # Default settings
 DEFAULT_MAX_TOKENS = 128000
 DEFAULT_THINKING_BUDGET = 32000  # Kept for compatibility but thinking tokens are included in output tokens
-STREAM_CHUNK_SIZE = 2  # Send keepalive every 2 chunks (reduced from 5)
 MAX_SEGMENT_SIZE = 16384  # 16KB per segment (reduced from 32KB)
 
 # Define beta parameter for 128K output
@@ -78,15 +209,17 @@ OUTPUT_128K_BETA = "output-128k-2025-02-19"
 
 # Set higher request timeout and stream chunk sizes
 MAX_TOKENS = 4096
-STREAM_CHUNK_SIZE = 2  # Number of chunks to process before sending a keepalive
 MAX_SEGMENT_SIZE = 16384  # 16KB chunks for content segments
 CHECKPOINT_INTERVAL = 2 * 60  # 2 minutes between checkpoints (reduced from 5)
+STREAM_POLL_INTERVAL = 0.5  # Seconds a response waits for new output before sending a partial update
+KEEPALIVE_INTERVAL = 2  # Seconds between keepalive events on an idle stream
+SESSION_RESUME_STALE_AFTER = 120  # A generation with no progress for this long is treated as interrupted
+SESSION_FOLLOW_POLL_INTERVAL = 1  # Seconds between backend polls when following another worker's generation
+SESSION_FOLLOW_CHECK_INTERVAL = 5  # Seconds between a generation's checks that some response still follows it
+STREAM_EVENT_LOG_MAX_EVENTS = 500  # Newest events kept per session for responses that fall behind
 
-# Retry settings
-MAX_RETRIES = 10  # Increase from 8 to 10
-MIN_BACKOFF_DELAY = 1  # Start with 1 second delay (reduced from 2)
-MAX_BACKOFF_DELAY = 45  # Max 45 seconds delay (reduced from 60)
-BACKOFF_FACTOR = 1.3  # Use 1.3 instead of 1.5 for more gradual increase
+# Retry settings: every Anthropic call retries under UPSTREAM_RETRY_POLICY (retry_policy.py),
+# tuned with RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_MAX_RETRIES and RETRY_DEADLINE
 
 # Gemini-specific settings
 GEMINI_MODEL = "gemini-2.5-pro-exp-03-25"
@@ -135,11 +268,15 @@ def upload():
 @app.route('/process', methods=['POST'])
 def process():
     data = request.get_json()
-    if not data or 'file_name' not in data or 'file_content' not in data:
+    try:
+        document = lookup_document(data)
+    except KeyError as e:
+        return unknown_document_response(e.args[0])
+    if not document and (not data or 'file_name' not in data or 'file_content' not in data):
         return jsonify({"error": "Missing file_name or file_content"}), 400
 
-    file_name = data['file_name']
-    file_content = data['file_content']
+    file_name = data.get('file_name', '')
+    file_content = data.get('file_content', '')
     
     # Get additional parameters from request or use defaults
     api_key = data.get('api_key', '')
@@ -150,40 +287,14 @@ def process():
     thinking_budget = int(data.get('thinking_budget', DEFAULT_THINKING_BUDGET))
 
     try:
-        # Convert base64 string back to bytes
-        file_content_bytes = base64.b64decode(file_content)
-        # Create a temporary file to save the uploaded file
-        temp_file_path = f"/tmp/{file_name}"
-        with open(temp_file_path, 'wb') as f:
-            f.write(file_content_bytes)
-            
-        # Determine file type and read content
-        file_ext = file_name.split('.')[-1].lower() if '.' in file_name else 'txt'
-        
-        # Process the file based on its type
-        file_text_content = ""
-        
-        if file_ext == 'pdf':
-            # Process PDF file
-            try:
-                reader = PyPDF2.PdfReader(temp_file_path)
-                for page_num in range(len(reader.pages)):
-                    file_text_content += reader.pages[page_num].extract_text() + "\n"
-            except Exception as e:
-                return jsonify({"error": f"Error processing PDF: {str(e)}"}), 500
-                
-        elif file_ext in ['docx', 'doc']:
-            # Process Word document
-            try:
-                doc = docx.Document(temp_file_path)
-                file_text_content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-            except Exception as e:
-                return jsonify({"error": f"Error processing Word document: {str(e)}"}), 500
-                
-        else:
-            # Process text-based file
-            with open(temp_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                file_text_content = f.read()
+        # Use the stored document, or decode the upload and extract its text based on the file type
+        try:
+            if document:
+                file_text_content = document['text']
+            else:
+                file_text_content = document_extractor.extract_upload(file_name, file_content)
+        except DocumentExtractionError as e:
+            return jsonify({"error": str(e)}), 500
                 
         # Now process the file content with Claude
         if not api_key:
@@ -403,6 +514,13 @@ def process_file():
     # Extract the API key and content
     api_key = data.get('api_key')
     content = data.get('content')
+    # Content can also reference a document uploaded to /api/documents
+    try:
+        document = lookup_document(data)
+    except KeyError as e:
+        return unknown_document_response(e.args[0])
+    if document:
+        content = document['text']
 
     print(f"Processing request with content length: {len(content) if content else 0}")
     print(f"Request JSON: {data}")
@@ -529,67 +647,253 @@ def process_file():
         print(f"Error in /api/process: {error_message}")
         return jsonify({'error': f'Server error: {error_message}'}), 500
 
+class UploadRequest(Request):
+    """
+    Request whose multipart file parts are written straight into UploadBuffers.
+
+    Werkzeug would otherwise spool each part to a temporary file of its own,
+    which read_upload_request then had to copy once more. The buffer is closed
+    with the request; handlers that close it earlier can do so safely.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadBuffer(spill_threshold=UPLOAD_SPILL_THRESHOLD)
+
+
+app.request_class = UploadRequest
+
+
+def read_upload_request():
+    """
+    Return (data, upload) for a JSON body or a multipart/form-data upload.
+
+    For multipart requests the form fields become the data dict ("true"/"false"
+    become booleans) and the binary 'file' part is returned as the UploadBuffer
+    it was parsed into (see UploadRequest), skipping base64 entirely. For JSON
+    requests upload is None.
+    """
+    if request.mimetype != 'multipart/form-data':
+        return request.get_json(), None
+
+    data = {}
+    for key, value in request.form.items():
+        data[key] = {'true': True, 'false': False}.get(value.lower(), value)
+
+    upload = None
+    file = request.files.get('file')
+    if file:
+        if not data.get('file_name'):
+            data['file_name'] = file.filename or ''
+        upload = file.stream
+        if not isinstance(upload, UploadBuffer):
+            upload = UploadBuffer.from_stream(file.stream, spill_threshold=UPLOAD_SPILL_THRESHOLD)
+    return data, upload
+
+
+def store_document(upload, file_name, file_type=None):
+    """Extract an upload's text, keep it in the document store and return the stored entry."""
+    file_type = file_type or file_type_from_name(file_name)
+    document_id = upload.sha256()
+    document = document_store.get(f"document:{document_id}")
+    if document is not None and document['file_type'] == file_type.lower():
+        return document
+
+    entry = document_extractor.extract_entry(upload, file_type)
+    document = dict(entry, document_id=document_id, file_name=file_name, created_at=time.time())
+    document_store.put(f"document:{document_id}", document)
+    return document
+
+
+def lookup_document(data):
+    """
+    Return the stored document referenced by data['document_id'], or None if there is none.
+
+    Raises KeyError for ids that are unknown or have expired.
+    """
+    document_id = data.get('document_id') if data else None
+    if not document_id:
+        return None
+    document = document_store.get(f"document:{document_id}")
+    if document is None:
+        raise KeyError(document_id)
+    return document
+
+
+def unknown_document_response(document_id):
+    return jsonify({
+        "success": False,
+        "error": f"Unknown or expired document_id {document_id}, please upload the document again"
+    }), 404
+
+
+def document_metadata(document):
+    """The document fields returned to clients (everything but the text)."""
+    return {key: value for key, value in document.items() if key != 'text'}
+
+
+@app.route('/api/documents', methods=['POST'])
+def upload_document():
+    """
+    Store a document once and return its document_id.
+
+    Accepts multipart/form-data with a 'file' part, or JSON with file_name and
+    base64 file_content (or plain text in content). The id is the SHA-256 of
+    the file, so uploading the same file again returns the same id.
+    """
+    try:
+        data, upload = read_upload_request()
+        data = data or {}
+        file_name = data.get('file_name') or 'document.txt'
+        if upload is None:
+            if data.get('file_content'):
+                upload = decode_upload(data['file_content'], UPLOAD_SPILL_THRESHOLD)
+            elif data.get('content'):
+                upload = UploadBuffer.from_bytes(data['content'].encode('utf-8'), UPLOAD_SPILL_THRESHOLD)
+            else:
+                return jsonify({"error": "A file, file_content or content is required"}), 400
+
+        with upload:
+            document = store_document(upload, file_name, data.get('file_type'))
+        print(f"Stored document {document['document_id']} ({file_name}, {document['chars']} characters)")
+        return jsonify(document_metadata(document)), 201
+    except DocumentExtractionError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Error storing document: {str(e)}"}), 500
+
+
+@app.route('/api/documents/<document_id>', methods=['GET'])
+def get_document(document_id):
+    """Return a stored document's metadata, so clients can check it is still available."""
+    document = document_store.get(f"document:{document_id}")
+    if document is None:
+        return unknown_document_response(document_id)
+    return jsonify(document_metadata(document)), 200
+
+
+def unknown_upload_response(upload_id):
+    return jsonify({"error": f"Unknown or expired upload {upload_id}"}), 404
+
+
+@app.route('/api/uploads', methods=['POST'])
+def init_chunked_upload():
+    """
+    Start a chunked upload.
+
+    Expects JSON with file_name and size (in bytes). The client then PUTs the
+    file in order to /api/uploads/<upload_id>?offset=N (raw bytes as the body),
+    can GET /api/uploads/<upload_id> to find where to resume after a dropped
+    connection, and finally POSTs /api/uploads/<upload_id>/finalize to turn it
+    into a stored document.
+    """
+    data = request.get_json()
+    if not data or not data.get('file_name') or data.get('size') is None:
+        return jsonify({"error": "file_name and size are required"}), 400
+    try:
+        size = int(data['size'])
+    except (TypeError, ValueError):
+        return jsonify({"error": "size must be an integer number of bytes"}), 400
+    try:
+        status = upload_staging.create(data['file_name'], size, data.get('file_type'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 413
+    return jsonify(dict(status, chunk_size=CHUNKED_UPLOAD_CHUNK_SIZE)), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def chunked_upload_status(upload_id):
+    try:
+        return jsonify(upload_staging.status(upload_id)), 200
+    except UploadNotFoundError:
+        return unknown_upload_response(upload_id)
+
+
+@app.route('/api/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    """Append the request body at ?offset=N; answers 409 with the expected offset if it doesn't match."""
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+    try:
+        # Read the body as a stream so a chunk is never buffered whole
+        new_offset = upload_staging.write_chunk(upload_id, offset, request.stream)
+    except UploadNotFoundError:
+        return unknown_upload_response(upload_id)
+    except ChunkOffsetError as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    return jsonify({"upload_id": upload_id, "offset": new_offset}), 200
+
+
+@app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+def abort_chunked_upload(upload_id):
+    try:
+        upload_staging.abort(upload_id)
+    except UploadNotFoundError:
+        return unknown_upload_response(upload_id)
+    return jsonify({"upload_id": upload_id, "aborted": True}), 200
+
+
+@app.route('/api/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_chunked_upload(upload_id):
+    """Extract a complete upload into the document store and return the document's metadata."""
+    try:
+        status, upload = upload_staging.finalize(upload_id)
+    except UploadNotFoundError:
+        return unknown_upload_response(upload_id)
+    except ChunkOffsetError as e:
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+
+    try:
+        with upload:
+            document = store_document(upload, status['file_name'], status.get('file_type'))
+    except DocumentExtractionError as e:
+        return jsonify({"error": str(e)}), 400
+    print(f"Finalized chunked upload {upload_id} as document {document['document_id']} ({status['size']} bytes)")
+    return jsonify(document_metadata(document)), 201
+
+
 @app.route('/api/analyze-tokens', methods=['POST'])
 def analyze_tokens():
     try:
-        data = request.get_json()
-        if not data:
+        data, upload = read_upload_request()
+        if not data and upload is None:
             return jsonify({"error": "No data provided"}), 400
         
-        print(f"Analyzing tokens for data of size: {len(str(data))}")
+        print(f"Analyzing tokens for data of size: {len(upload) if upload is not None else len(str(data))}")
         
         content = data.get('content', '')
         if not content:
             content = data.get('source', '')
+
+        # Content can also reference a document uploaded to /api/documents
+        try:
+            document = lookup_document(data)
+        except KeyError as e:
+            if upload is not None:
+                upload.close()
+            return unknown_document_response(e.args[0])
             
-        file_type = data.get('file_type', 'txt')
+        file_type = data.get('file_type') or (file_type_from_name(data.get('file_name')) if upload is not None else 'txt')
         
-        # Handle PDF files (which are sent as base64)
-        if file_type == 'pdf':
-            # Recognize base64 data (could start with data:application/pdf;base64, or just be raw base64)
-            if ';base64,' in content:
-                # Extract the base64 part
-                content = content.split(';base64,')[1]
-            
+        if document:
+            content = document['text']
+            if upload is not None:
+                upload.close()
+
+        # Multipart uploads carry the raw file bytes
+        elif upload is not None:
             try:
-                # Decode base64
-                pdf_data = base64.b64decode(content)
-                
-                # Create a file-like object
-                pdf_file = io.BytesIO(pdf_data)
-                
-                # Extract text from the PDF
-                reader = PyPDF2.PdfReader(pdf_file)
-                text_content = ""
-                
-                # Extract text from each page
-                for page_num in range(len(reader.pages)):
-                    text_content += reader.pages[page_num].extract_text() + "\n"
-                
-                # Use the extracted text for token analysis
-                content = text_content
-                
-            except Exception as e:
-                return jsonify({"error": f"Error processing PDF: {str(e)}"}), 400
-        
-        # Handle DOCX files
-        elif file_type in ['docx', 'doc']:
+                with upload:
+                    content = document_extractor.extract(upload, file_type)
+            except DocumentExtractionError as e:
+                return jsonify({"error": str(e)}), 400
+
+        # Binary documents (PDF, DOCX) sent as JSON are base64 encoded; extract their text for token analysis
+        elif content and document_extractor.is_binary(file_type):
             try:
-                # Decode base64
-                docx_data = base64.b64decode(content)
-                
-                # Create a file-like object
-                docx_file = io.BytesIO(docx_data)
-                
-                # Extract text from the DOCX
-                doc = docx.Document(docx_file)
-                text_content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-                
-                # Use the extracted text for token analysis
-                content = text_content
-                
-            except Exception as e:
-                return jsonify({"error": f"Error processing DOCX: {str(e)}"}), 400
+                content = document_extractor.extract_base64(content, file_type)
+            except DocumentExtractionError as e:
+                return jsonify({"error": str(e)}), 400
         
         # If no content after processing, return an error
         if not content:
@@ -598,11 +902,9 @@ def analyze_tokens():
         # Define the system prompt to include in token estimation - Use the same detailed prompt as in process_file
         system_prompt = "I will provide you with a file or a content, analyze its content, and transform it into a visually appealing and well-structured webpage.### Content Requirements* Maintain the core information from the original file while presenting it in a clearer and more visually engaging format.⠀Design Style* Follow a modern and minimalistic design inspired by Linear App.* Use a clear visual hierarchy to emphasize important content.* Adopt a professional and harmonious color scheme that is easy on the eyes for extended reading.⠀Technical Specifications* Use HTML5, TailwindCSS 3.0+ (via CDN), and necessary JavaScript.* Implement a fully functional dark/light mode toggle, defaulting to the system setting.* Ensure clean, well-structured code with appropriate comments for easy understanding and maintenance.⠀Responsive Design* The page must be fully responsive, adapting seamlessly to mobile, tablet, and desktop screens.* Optimize layout and typography for different screen sizes.* Ensure a smooth and intuitive touch experience on mobile devices.⠀Icons & Visual Elements* Use professional icon libraries like Font Awesome or Material Icons (via CDN).* Integrate illustrations or charts that best represent the content.* Avoid using emojis as primary icons.* Check if any icons cannot be loaded.⠀User Interaction & ExperienceEnhance the user experience with subtle micro-interactions:* Buttons should have slight enlargement and color transitions on hover.* Cards should feature soft shadows and border effects on hover.* Implement smooth scrolling effects throughout the page.* Content blocks should have an elegant fade-in animation on load.⠀Performance Optimization* Ensure fast page loading by avoiding large, unnecessary resources.* Use modern image formats (WebP) with proper compression.* Implement lazy loading for content-heavy pages.⠀Output Requirements* Deliver a fully functional standalone HTML file, including all necessary CSS and JavaScript.* Ensure the code meets W3C standards with no errors or warnings.* Maintain consistent design and functionality across different browsers.⠀Create the most effective and visually appealing webpage based on the uploaded file's content type (document, data, images, etc.).Your output is only one HTML file, do not present any other notes on the HTML."
         
-        # Estimated system prompt tokens (if exact count not available)
-        system_prompt_tokens = len(system_prompt) // 3
-        
-        # Estimate tokens in content
-        content_tokens = len(content) // 4
+        # Count system prompt and content tokens locally
+        system_prompt_tokens = token_counter.count(system_prompt)
+        content_tokens = token_counter.count(content)
         
         # Total estimated tokens
         estimated_tokens = system_prompt_tokens + content_tokens
@@ -662,6 +964,13 @@ def format_stream_event(event_type, data=None):
     buffer += "\n"
     return buffer
 
+def materialize_checkpoint(session_data, checkpoint_id):
+    """Return the HTML generated up to a checkpoint, or None if it is unknown."""
+    checkpoint = session_data.get('checkpoints', {}).get(checkpoint_id)
+    if checkpoint is None:
+        return None
+    return session_data['generated_text'].slice(0, checkpoint['offset'])
+
 def create_stream_generator(client, system_prompt, user_message, model, max_tokens, temperature, thinking_budget=None):
     """Create a generator that yields SSE events for streaming Claude responses"""
     try:
@@ -760,13 +1069,639 @@ def create_stream_generator(client, system_prompt, user_message, model, max_toke
 
 
 
+def generation_cache_key(provider, content, format_prompt, model, temperature, max_tokens, thinking_budget=None):
+    """Return the generation cache key for a request: a hash of the content and every parameter that shapes the output."""
+    params = json.dumps({
+        "provider": provider,
+        "content": hashlib.sha256(content.encode('utf-8', errors='ignore')).hexdigest(),
+        "format_prompt": format_prompt or '',
+        "model": model,
+        "temperature": float(temperature),
+        "max_tokens": int(max_tokens),
+        "thinking_budget": thinking_budget
+    }, sort_keys=True)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()
+
+
+def cache_generation(cache_key, html, usage):
+    """Store a finished generation in the generation cache."""
+    if cache_key and html:
+        generation_cache[cache_key] = {'html': html, 'usage': usage, 'created_at': time.time()}
+
+
+def claim_generation(cache_key, session_id, session_data):
+    """
+    Register a session as the running generation for cache_key, unless one already runs.
+
+    Returns (session_id, session_data) of the generation already running for
+    the same key, or None when the caller should start the generation itself.
+    """
+    with inflight_generations_lock:
+        running = inflight_generations.get(cache_key)
+        if running is not None and running[1].get('active') and not running[1].get('complete'):
+            return running
+        inflight_generations[cache_key] = (session_id, session_data)
+    return None
+
+
+def release_generation(cache_key, session_id):
+    """Remove a finished generation from the in-flight registry."""
+    with inflight_generations_lock:
+        running = inflight_generations.get(cache_key)
+        if running is not None and running[0] == session_id:
+            del inflight_generations[cache_key]
+
+
+def cached_generation_session(cached, **fields):
+    """
+    Build a completed session that replays a cached generation.
+
+    The HTML is split into segments like a live generation, so stream_session
+    sends the same events (and reconnects work the same way) as for a real one.
+    """
+    html = cached['html']
+    output_buffer = OutputBuffer(html)
+    html_segments = SegmentLog(output_buffer)
+    for end in range(MAX_SEGMENT_SIZE, len(html) + MAX_SEGMENT_SIZE, MAX_SEGMENT_SIZE):
+        html_segments.close_segment(min(end, len(html)), len(html_segments) + 1)
+    events = StreamEventLog()
+    events.close()
+    usage = dict(cached.get('usage') or {}, cached=True)
+    session_data = dict(fields)
+    session_data.update({
+        'created_at': time.time(),
+        'last_updated': time.time(),
+        'message_id': f"cached_{uuid.uuid4()}",
+        'html_segments': html_segments,
+        'generated_text': output_buffer,
+        'chunk_count': len(html_segments),
+        'events': events,
+        'usage': usage,
+        'complete': True,
+        'active': False,
+        'from_cache': True
+    })
+    return session_data
+
+
+def run_claude_generation(session_id, session_data, client, system_prompt, user_content, max_tokens, temperature, thinking_budget):
+    """
+    Stream a Claude generation into a session of the session cache.
+
+    Runs in a background thread instead of inside the HTTP response, so the
+    generation keeps going if the browser disconnects. Responses follow it
+    through the session's segment log and event log (see stream_session),
+    which lets a reconnecting browser catch up without a new generation.
+    """
+    events = session_data['events']
+    stream = None
+    final_usage = None  # Usage the API reported for the finished message
+    message_id = session_data.get('message_id')
+    generated_text = session_data['generated_text']
+    start_time = time.time()
+    chunk_count = 0
+    
+    try:
+        # Retry transient failures under the shared retry policy
+        retry = UPSTREAM_RETRY_POLICY.start()
+        max_retries = UPSTREAM_RETRY_POLICY.max_retries
+        
+        while True:
+            try:
+                # Use the Claude 3.7 specific implementation with beta parameter
+                with client.beta.messages.stream(
+                    model="claude-3-7-sonnet-20250219",
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    system=system_prompt,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {
+                                    "type": "text",
+                                    "text": user_content
+                                }
+                            ]
+                        }
+                    ],
+                    thinking={
+                        "type": "enabled",
+                        "budget_tokens": thinking_budget
+                    },
+                    betas=[OUTPUT_128K_BETA],  # Using betas parameter instead of headers
+                ) as stream:
+                    message_id = str(uuid.uuid4())
+                    # Append-only buffer shared with the session cache, so each delta costs O(1)
+                    generated_text = OutputBuffer()
+                    # Closed segments are recorded as offsets into generated_text, never copied
+                    html_segments = SegmentLog(generated_text)
+                    # Checkpoints point into the buffer of this attempt only
+                    with session_cache.lock_for(session_id):
+                        session_data.update(
+                            message_id=message_id,
+                            generated_text=generated_text,
+                            html_segments=html_segments,
+                            checkpoints={},
+                            chunk_count=0
+                        )
+                    session_cache.persist(session_id, reset_segments=True)
+                    events.notify()
+                    start_time = time.time()
+                    chunk_count = 0
+                    
+                    current_segment = ""
+                    current_segment_size = 0
+                    max_segment_size = MAX_SEGMENT_SIZE  # 16KB per segment
+                    
+                    # Add checkpoint tracking
+                    last_checkpoint_time = time.time()
+                    checkpoint_counter = 0
+                    last_follow_check = time.time()
+                    
+                    for chunk in stream:
+                        current_time = time.time()
+                        chunk_count += 1
+                        
+                        # Stop paying for output once every browser has been gone too long to resume
+                        if current_time - last_follow_check >= SESSION_FOLLOW_CHECK_INTERVAL:
+                            last_follow_check = current_time
+                            # Show other workers the generation is alive even while no segment closes
+                            session_cache.heartbeat(session_id)
+                            if generation_abandoned(session_id, session_data, current_time):
+                                app.logger.info(f"Stopping generation for session {session_id}: no response has followed it for {SESSION_RESUME_STALE_AFTER}s")
+                                events.publish("error", {
+                                    "type": "error",
+                                    "error": "Generation was stopped because no client was following it. Please try again.",
+                                    "session_id": session_id
+                                })
+                                # Leaving the with block closes the upstream stream
+                                return
+                        
+                        # Update session with current progress
+                        session_data['last_updated'] = current_time
+                        session_data['chunk_count'] = chunk_count
+                        
+                        # Handle thinking updates
+                        if hasattr(chunk, "thinking") and chunk.thinking:
+                            events.publish("content", {
+                                "type": "thinking_update",
+                                "chunk_id": f"{message_id}_{chunk_count}",
+                                "thinking": {
+                                    "content": chunk.thinking.content if hasattr(chunk.thinking, "content") else ""
+                                }
+                            })
+                        
+                        # Handle content block deltas (the actual generated text)
+                        if hasattr(chunk, "delta") and hasattr(chunk.delta, "text"):
+                            delta_text = chunk.delta.text
+                            generated_text.append(delta_text)
+                            
+                            # Check if we need to create a checkpoint (every 2 minutes)
+                            if current_time - last_checkpoint_time > CHECKPOINT_INTERVAL:
+                                checkpoint_id = f"cp_{session_id}_{checkpoint_counter}"
+                                checkpoint_counter += 1
+                                last_checkpoint_time = current_time
+                                
+                                # Store checkpoint in the session as an offset into the
+                                # output buffer; use materialize_checkpoint() to get the HTML
+                                with session_cache.lock_for(session_id):
+                                    session_data.setdefault("checkpoints", {})[checkpoint_id] = {
+                                        "offset": len(generated_text),
+                                        "segment": len(html_segments),
+                                        "chunk_id": f"{message_id}_{chunk_count}",
+                                        "timestamp": current_time,
+                                        "chunk_count": chunk_count
+                                    }
+                                
+                                events.publish("status", {
+                                    "type": "checkpoint",
+                                    "checkpoint_id": checkpoint_id,
+                                    "timestamp": current_time,
+                                    "chunk_id": f"{message_id}_{chunk_count}",
+                                    "chunk_count": chunk_count,
+                                    "message": "Progress checkpoint created"
+                                })
+                            
+                            # Build up the current segment
+                            current_segment += delta_text
+                            current_segment_size += len(delta_text)
+                            
+                            # Close the segment when it reaches max size or ends with a complete HTML tag
+                            if (current_segment_size >= max_segment_size or 
+                                (current_segment_size > 256 and  # Reduced from 512 bytes to 256 bytes
+                                 (delta_text.endswith('</div>') or 
+                                  delta_text.endswith('</section>') or
+                                  delta_text.endswith('</p>') or
+                                  delta_text.endswith('</table>') or
+                                  delta_text.endswith('</li>') or
+                                  delta_text.endswith('</h1>') or
+                                  delta_text.endswith('</h2>') or
+                                  delta_text.endswith('</h3>') or
+                                  delta_text.endswith('</html>')))):
+                                
+                                # Record this segment in the shared log and wake the responses
+                                segment_counter = html_segments.close_segment(len(generated_text), chunk_count)
+                                session_cache.append_segment(session_id, segment_counter, current_segment, chunk_count)
+                                # Refresh LRU position and size accounting for this session
+                                session_cache.touch(session_id)
+                                events.notify()
+                                
+                                # Reset for next segment
+                                current_segment = ""
+                                current_segment_size = 0
+                    
+                    # Record any remaining segment
+                    if current_segment:
+                        segment_counter = html_segments.close_segment(len(generated_text), chunk_count)
+                        session_cache.append_segment(session_id, segment_counter, current_segment, chunk_count)
+                        events.notify()
+                    
+                    # If we completed the stream successfully and have content
+                    if len(generated_text) > 0:
+                        # The stream's final message carries the token counts the API charged
+                        try:
+                            final_usage = stream.get_final_message().usage
+                        except Exception as e:
+                            app.logger.warning(f"No usage reported for session {session_id}: {str(e)}")
+                        # Stream completed successfully, break out of retry loop
+                        break
+                    else:
+                        app.logger.warning(f"Empty completion for session {session_id}, chunk count: {chunk_count}")
+                        delay = retry.next_delay()
+                        if delay is None:
+                            break
+                        time.sleep(delay)
+            
+            except Exception as e:
+                error_str = str(e)
+                error_details = ""
+                
+                # Check if it's an API error with a response
+                if hasattr(e, 'response') and hasattr(e.response, 'json'):
+                    try:
+                        error_details = e.response.json()
+                        app.logger.error(f"API Error details: {error_details}")
+                    except Exception as json_err:
+                        app.logger.error(f"Failed to parse error response: {str(json_err)}")
+                
+                # Timeouts, rate limits, server errors and overload are retried as the policy says
+                status = error_status(e)
+                if isinstance(error_details, dict) and error_details.get('code') == 529:
+                    status = 529
+                if status is not None or isinstance(e, anthropic.APIConnectionError):
+                    delay = retry.next_delay(status, error_retry_after(e))
+                    if delay is not None:
+                        reason = "overloaded" if status == 529 else f"unavailable ({status or 'connection error'})"
+                        app.logger.warning(f"Anthropic API {reason}. Retry {retry.retries}/{max_retries} after {delay:.2f}s")
+                        events.publish("status", {
+                            "type": "status", 
+                            "message": f"Anthropic API temporarily {reason}. Retrying in {delay:.1f}s (attempt {retry.retries}/{max_retries})...",
+                            "session_id": session_id,
+                            "retry": retry.retries,
+                            "max_retries": max_retries
+                        })
+                        
+                        time.sleep(delay)
+                        continue  # Try again
+                    if status == 529:
+                        app.logger.error(f"Retries exhausted for API overload after {retry.retries} attempts")
+                        events.publish("error", {
+                            "type": "error",
+                            "error": "Maximum retry attempts exceeded. Please try again later.",
+                            "details": "The AI service is currently experiencing high load. Your request could not be completed after multiple attempts.",
+                            "code": 529,
+                            "session_id": session_id
+                        })
+                        return
+                
+                # For other errors that are not 529
+                app.logger.error(f"Error in Claude generation: {error_str}")
+                if error_details:
+                    app.logger.error(f"Error details: {error_details}")
+                
+                events.publish("error", {
+                    "type": "error",
+                    "error": error_str,
+                    "details": str(error_details),
+                    "session_id": session_id
+                })
+                return
+        
+        # Record usage statistics when available
+        usage_data = None
+        if final_usage is not None and getattr(final_usage, "input_tokens", 0):
+            usage_data = {
+                "input_tokens": final_usage.input_tokens,
+                "output_tokens": getattr(final_usage, "output_tokens", 0) or 0
+            }
+            # Calculate cost according to Anthropic pricing
+            usage_data["total_cost"] = (usage_data["input_tokens"] / 1000000 * 3.0) + (usage_data["output_tokens"] / 1000000 * 15.0)
+            # Real counts improve later local estimates
+            token_counter.calibrate('claude', system_prompt + user_content, usage_data["input_tokens"])
+        else:
+            # If usage is not available from stream, count locally
+            system_prompt_tokens = token_counter.count(system_prompt)
+            content_tokens = token_counter.count(user_content)
+            output_tokens = token_counter.count(generated_text.getvalue())
+            
+            usage_data = {
+                "input_tokens": system_prompt_tokens + content_tokens,
+                "output_tokens": output_tokens,
+                "time_elapsed": round(time.time() - start_time, 2),
+                "total_cost": (system_prompt_tokens + content_tokens) / 1000000 * 3.0 + output_tokens / 1000000 * 15.0
+            }
+        
+        # Mark this session as complete
+        with session_cache.lock_for(session_id):
+            session_data.update(complete=True, usage=usage_data)
+        session_cache.touch(session_id)
+        session_cache.persist(session_id)
+        cache_generation(session_data.get('cache_key'), generated_text.getvalue(), usage_data)
+    except Exception as e:
+        app.logger.error(f"Unexpected error in Claude generation: {str(e)}")
+        # Include stack trace for better debugging
+        app.logger.error(traceback.format_exc())
+        events.publish("error", {
+            "type": "error",
+            "error": str(e),
+            "details": traceback.format_exc(),
+            "session_id": session_id
+        })
+    finally:
+        session_data['active'] = False
+        events.close()
+        release_generation(session_data.get('cache_key'), session_id)
+
+def follow_persisted_session(session_id, session_data):
+    """
+    Mirror a generation running in another worker into this process.
+
+    Polls the session backend for newly persisted segments and appends them to
+    the local session, so stream_session can follow it like a local generation.
+    """
+    events = session_data['events']
+    last_mark = 0
+    try:
+        while True:
+            # Tell the generating worker a response here still follows the generation
+            if session_data.get('followers', 0) > 0 and time.time() - last_mark >= SESSION_FOLLOW_CHECK_INTERVAL:
+                last_mark = time.time()
+                session_cache.backend.mark_followed(session_id, last_mark)
+            
+            html_segments = session_data['html_segments']
+            stored = session_cache.backend.load_session(session_id, after_segment=len(html_segments))
+            if stored is None:
+                events.publish("error", {
+                    "type": "error",
+                    "error": "Session is no longer available. Please try again.",
+                    "session_id": session_id
+                })
+                return
+            fields, segments = stored
+            
+            if fields.get('message_id') != session_data.get('message_id'):
+                # The other worker retried and started over; follow its new attempt from the start
+                output_buffer = OutputBuffer()
+                with session_cache.lock_for(session_id):
+                    session_data.update(
+                        message_id=fields.get('message_id'),
+                        generated_text=output_buffer,
+                        html_segments=SegmentLog(output_buffer)
+                    )
+                continue
+            
+            for _, text, chunk_count in segments:
+                html_segments.buffer.append(text)
+                html_segments.close_segment(len(html_segments.buffer), chunk_count)
+            if segments:
+                events.notify()
+            
+            if fields.get('complete'):
+                with session_cache.lock_for(session_id):
+                    session_data.update(
+                        complete=True,
+                        usage=fields.get('usage'),
+                        chunk_count=fields.get('chunk_count', 0)
+                    )
+                return
+            
+            if time.time() - fields.get('last_updated', 0) > SESSION_RESUME_STALE_AFTER:
+                events.publish("error", {
+                    "type": "error",
+                    "error": "Generation was interrupted. Please try again.",
+                    "session_id": session_id
+                })
+                return
+            
+            time.sleep(SESSION_FOLLOW_POLL_INTERVAL)
+    except Exception as e:
+        app.logger.error(f"Error following session {session_id}: {str(e)}")
+        events.publish("error", {
+            "type": "error",
+            "error": f"Failed to resume: {str(e)}",
+            "session_id": session_id
+        })
+    finally:
+        session_data['active'] = False
+        events.close()
+
+def generation_abandoned(session_id, session_data, now):
+    """
+    True when no response has followed a running generation for SESSION_RESUME_STALE_AFTER seconds.
+
+    Past that point a reconnect would be treated as interrupted anyway, so the
+    rest of the output could never be delivered. Responses following the
+    session from another worker are seen through the backend's follow marks.
+    """
+    with session_cache.lock_for(session_id):
+        if session_data.get('followers', 0) > 0:
+            return False
+        last_followed = session_data.get('last_followed', session_data.get('created_at', now))
+    if now - last_followed <= SESSION_RESUME_STALE_AFTER:
+        return False
+    try:
+        followed_elsewhere = session_cache.backend.last_followed(session_id)
+    except Exception as e:
+        app.logger.warning(f"Could not read follow marks of session {session_id}: {str(e)}")
+        return False
+    return followed_elsewhere is None or now - followed_elsewhere > SESSION_RESUME_STALE_AFTER
+
+def prepare_resume(session_id, session_data):
+    """
+    Decide whether a reconnect can be served from the session cache.
+
+    True when the session is complete or its generation is still running here
+    or (for sessions loaded from the backend) recently active in another
+    worker; False when the generation was interrupted and must start over.
+    """
+    with session_cache.lock_for(session_id):
+        if session_data.get('complete') or session_data.get('active'):
+            return True
+        if not session_data.get('rehydrated'):
+            return False
+        after_segment = len(session_data['html_segments'])
+    
+    # The owning worker may have made progress since this copy was loaded
+    try:
+        stored = session_cache.backend.load_session(session_id, after_segment=after_segment)
+    except Exception as e:
+        app.logger.warning(f"Could not refresh session {session_id}: {str(e)}")
+        stored = None
+    
+    with session_cache.lock_for(session_id):
+        if session_data.get('complete') or session_data.get('active'):
+            return True
+        if stored is not None:
+            session_data['last_updated'] = max(session_data.get('last_updated', 0), stored[0].get('last_updated', 0))
+        if time.time() - session_data.get('last_updated', 0) > SESSION_RESUME_STALE_AFTER:
+            return False
+        session_data['active'] = True
+    
+    threading.Thread(target=follow_persisted_session, args=(session_id, session_data), daemon=True).start()
+    return True
+
+def resume_segment(session_data, last_chunk_id):
+    """Return the number of segments the client already has, based on its last chunk id."""
+    if not last_chunk_id or '_' not in str(last_chunk_id):
+        return 0
+    message_id, _, chunk_count = str(last_chunk_id).rpartition('_')
+    if message_id != session_data.get('message_id'):
+        # The chunk belongs to an earlier attempt whose output was discarded
+        return 0
+    try:
+        return session_data['html_segments'].segments_through_chunk(int(chunk_count))
+    except ValueError:
+        return 0
+
+def stream_session(session_id, session_data, from_segment=0, is_resumed=False):
+    """
+    Yield SSE events for the generation stored in a session.
+
+    Replays the segments after `from_segment` straight from the segment log,
+    then follows the running generation until it completes or fails. While
+    it runs, the response counts as one of the session's followers, which
+    keeps the generation from being stopped as abandoned.
+    """
+    with session_cache.lock_for(session_id):
+        session_data['followers'] = session_data.get('followers', 0) + 1
+    try:
+        yield from session_events(session_id, session_data, from_segment, is_resumed)
+    finally:
+        # Runs when the response ends or the client disconnects (the generator is closed)
+        with session_cache.lock_for(session_id):
+            session_data['followers'] -= 1
+            session_data['last_followed'] = time.time()
+
+def session_events(session_id, session_data, from_segment, is_resumed):
+    """Yield the SSE events of stream_session."""
+    events = session_data['events']
+    yield format_stream_event("stream_start", {
+        "message": "Resuming stream" if is_resumed else "Stream starting",
+        "session_id": session_id,
+        "is_resumed": is_resumed
+    })
+    
+    html_segments = session_data['html_segments']
+    # Replayed output (a resume or a generation cache hit) is flagged for the client
+    is_cached = is_resumed or session_data.get('from_cache', False)
+    segment_cursor = from_segment
+    partial_length = 0
+    # A resumed client has already seen earlier status events
+    event_cursor = len(events) if is_resumed else 0
+    last_keepalive = time.time()
+    
+    while True:
+        new_events, event_cursor, finished = events.wait(event_cursor, STREAM_POLL_INTERVAL)
+        for event_type, data in new_events:
+            yield format_stream_event(event_type, data)
+        
+        if session_data['html_segments'] is not html_segments:
+            # A retry started a new attempt with a fresh buffer
+            html_segments = session_data['html_segments']
+            segment_cursor = 0
+            partial_length = 0
+        message_id = session_data.get('message_id')
+        
+        for segment_num, segment in html_segments.segments_after(segment_cursor):
+            segment_chunk_count = html_segments.chunk_count(segment_num)
+            yield format_stream_event("content", {
+                "type": "content_block_delta",
+                "chunk_id": f"{message_id}_{segment_chunk_count}",
+                "delta": {
+                    "text": segment
+                },
+                "segment": segment_num,
+                "session_id": session_id,
+                "chunk_count": segment_chunk_count,
+                "is_cached": is_cached
+            })
+            segment_cursor = segment_num
+            partial_length = 0
+        
+        if finished:
+            if session_data.get('complete'):
+                chunk_count = session_data.get('chunk_count', 0)
+                yield format_stream_event("content", {
+                    "type": "message_complete",
+                    "message_id": message_id,
+                    "chunk_id": f"{message_id}_{chunk_count}",
+                    "usage": session_data.get('usage'),
+                    "html": html_segments.buffer.getvalue(),
+                    "session_id": session_id,
+                    "final_chunk_count": chunk_count,
+                    "segment_count": len(html_segments),
+                    "is_cached": is_cached
+                })
+                yield format_stream_event("stream_end", {"message": "Stream complete", "session_id": session_id})
+            return
+        
+        # Send the still-open segment as a partial update so the preview keeps moving.
+        # Read the chunk count first so a resume never skips a segment closed meanwhile.
+        chunk_count = session_data.get('chunk_count', 0)
+        segment_end = html_segments.bounds(segment_cursor)[1] if segment_cursor else 0
+        tail = html_segments.buffer.slice(segment_end)
+        if len(tail) > partial_length:
+            yield format_stream_event("content", {
+                "type": "content_block_delta",
+                "chunk_id": f"{message_id}_{chunk_count}",
+                "delta": {
+                    "text": tail
+                },
+                "partial": True,
+                "session_id": session_id,
+                "chunk_count": chunk_count
+            })
+            partial_length = len(tail)
+        
+        if time.time() - last_keepalive >= KEEPALIVE_INTERVAL:
+            last_keepalive = time.time()
+            yield format_stream_event("keepalive", {
+                "timestamp": last_keepalive,
+                "session_id": session_id,
+                "chunk_count": session_data.get('chunk_count', 0),
+                "segment": segment_cursor
+            })
+
+def event_stream_response(generator):
+    """Wrap an SSE generator in a streaming response with proxy buffering disabled."""
+    response = Response(stream_with_context(generator), 
+                         content_type='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+    response.headers['Cache-Control'] = 'no-cache, no-transform'
+    response.headers['Connection'] = 'keep-alive'
+    response.headers['Keep-Alive'] = 'timeout=3600, max=2000'  # 60 minutes timeout (increased from 30)
+    response.headers['X-Accel-Limit-Rate'] = '0'  # Disable rate limiting
+    return response
+
+
 @app.route('/api/process-stream', methods=['POST'])
 def process_stream():
     """
     Process a streaming request with reconnection support.
     """
-    # Extract request data
-    data = request.get_json()
+    # Extract request data (JSON, or multipart/form-data with a binary 'file' part)
+    data, upload = read_upload_request()
     api_key = data.get('api_key')
     
     # Check for file upload fields
@@ -777,57 +1712,28 @@ def process_stream():
     content = data.get('content', '')
     if not content:
         content = data.get('source', '')  # Fallback to 'source' if 'content' is empty
+
+    # Content can also reference a document uploaded to /api/documents (cheap to resend on reconnects)
+    try:
+        document = lookup_document(data)
+    except KeyError as e:
+        if upload is not None:
+            upload.close()
+        return unknown_document_response(e.args[0])
     
     # Handle file content if provided
-    if file_name and file_content:
+    if document:
+        content = document['text']
+        if upload is not None:
+            upload.close()
+    elif upload is not None or (file_name and file_content):
         try:
-            # Extract file extension
-            file_ext = file_name.split('.')[-1].lower() if '.' in file_name else 'txt'
-            print(f"Processing uploaded file: {file_name} with extension {file_ext}")
-            
-            # Create a temporary file
-            temp_file_path = f"/tmp/{file_name}"
-            
-            # For binary files (PDF, DOCX, etc.), decode base64
-            try:
-                file_content_bytes = base64.b64decode(file_content)
-                print(f"Successfully decoded base64 content, size: {len(file_content_bytes)} bytes")
-            except Exception as decode_error:
-                print(f"Error decoding base64 content: {str(decode_error)}")
-                # Try to fix padding if that's the issue
-                padded_content = file_content + '=' * (4 - len(file_content) % 4) if len(file_content) % 4 != 0 else file_content
-                file_content_bytes = base64.b64decode(padded_content)
-                print(f"Successfully decoded base64 content after padding fix, size: {len(file_content_bytes)} bytes")
-            
-            with open(temp_file_path, 'wb') as f:
-                f.write(file_content_bytes)
-            print(f"Wrote temporary file to {temp_file_path}")
-            
-            # Process the file based on type
-            if file_ext == 'pdf':
-                # Process PDF
-                print(f"Processing PDF file")
-                reader = PyPDF2.PdfReader(temp_file_path)
-                text_content = ""
-                for page_num in range(len(reader.pages)):
-                    text_content += reader.pages[page_num].extract_text() + "\n"
-                content = text_content
-                print(f"Extracted {len(content)} characters from PDF")
-                
-            elif file_ext in ['docx', 'doc']:
-                # Process Word document
-                print(f"Processing Word document")
-                doc = docx.Document(temp_file_path)
-                content = "\n".join([paragraph.text for paragraph in doc.paragraphs])
-                print(f"Extracted {len(content)} characters from Word document")
-                
+            print(f"Processing uploaded file: {file_name}")
+            if upload is not None:
+                with upload:
+                    content = document_extractor.extract(upload, file_type_from_name(file_name))
             else:
-                # For text-based files, assume it's already decoded properly
-                print(f"Processing text-based file")
-                with open(temp_file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                print(f"Read {len(content)} characters from text file")
-                
+                content = document_extractor.extract_upload(file_name, file_content)
             print(f"Successfully processed uploaded file: {file_name}, extracted {len(content)} characters")
             
         except Exception as e:
@@ -852,42 +1758,17 @@ def process_stream():
     is_reconnect = data.get('is_reconnect', False)
     last_chunk_id = data.get('last_chunk_id', None)
     
-    # Check if we have a cached response for this session
-    if is_reconnect and session_id in session_cache:
-        cached_data = session_cache[session_id]
-        app.logger.info(f"Found cached data for session {session_id}, resuming from chunk {last_chunk_id}")
-        
-        # If we have partial content already generated, use that to save time
-        if 'generated_text' in cached_data:
-            # Use streaming response to deliver cached content and then continue
-            return Response(
-                #stream_with_context(resume_from_cache(session_id, last_chunk_id, api_key)),
-                content_type='text/event-stream'
-            )
-    
-    # Create Anthropic client
-    client = None
-    try:
-        client = create_anthropic_client(api_key)
-    except Exception as e:
-        return jsonify({
-            "success": False,
-            "error": f"API key validation failed: {str(e)}"
-        })
-    
-    # Initialize session cache for this request
-    session_cache[session_id] = {
-        'created_at': time.time(),
-        'last_updated': time.time(),
-        'html_segments': [],
-        'generated_text': '',
-        'chunk_count': 0,
-        'user_content': content[:100000],  # Store for potential reconnection
-        'format_prompt': format_prompt,
-        'model': model,
-        'max_tokens': max_tokens,
-        'temperature': temperature
-    }
+    # Serve reconnects from the session cache while the generation is running or once it finished
+    resume_id = session_id
+    cached_data = session_cache.load(session_id) if is_reconnect else None
+    if cached_data is not None and cached_data.get('alias_of'):
+        # This session had joined an identical generation; resume that one
+        resume_id = cached_data['alias_of']
+        cached_data = session_cache.load(resume_id)
+    if cached_data is not None and prepare_resume(resume_id, cached_data):
+        from_segment = resume_segment(cached_data, last_chunk_id)
+        app.logger.info(f"Resuming session {resume_id} after segment {from_segment} (last chunk {last_chunk_id})")
+        return event_stream_response(stream_session(resume_id, cached_data, from_segment=from_segment, is_resumed=True))
     
     # Prepare system prompt
     system_prompt = "I will provide you with a file or a content, analyze its content, and transform it into a visually appealing and well-structured webpage.### Content Requirements* Maintain the core information from the original file while presenting it in a clearer and more visually engaging format.⠀Design Style* Follow a modern and minimalistic design inspired by Linear App.* Use a clear visual hierarchy to emphasize important content.* Adopt a professional and harmonious color scheme that is easy on the eyes for extended reading.⠀Technical Specifications* Use HTML5, TailwindCSS 3.0+ (via CDN), and necessary JavaScript.* Implement a fully functional dark/light mode toggle, defaulting to the system setting.* Ensure clean, well-structured code with appropriate comments for easy understanding and maintenance.⠀Responsive Design* The page must be fully responsive, adapting seamlessly to mobile, tablet, and desktop screens.* Optimize layout and typography for different screen sizes.* Ensure a smooth and intuitive touch experience on mobile devices.⠀Icons & Visual Elements* Use professional icon libraries like Font Awesome or Material Icons (via CDN).* Integrate illustrations or charts that best represent the content.* Avoid using emojis as primary icons.* Check if any icons cannot be loaded.⠀User Interaction & ExperienceEnhance the user experience with subtle micro-interactions:* Buttons should have slight enlargement and color transitions on hover.* Cards should feature soft shadows and border effects on hover.* Implement smooth scrolling effects throughout the page.* Content blocks should have an elegant fade-in animation on load.⠀Performance Optimization* Ensure fast page loading by avoiding large, unnecessary resources.* Use modern image formats (WebP) with proper compression.* Implement lazy loading for content-heavy pages.* For large outputs, make sure the HTML can be incrementally rendered and uses efficient DOM structures.⠀Output Requirements* Deliver a fully functional standalone HTML file, including all necessary CSS and JavaScript.* Ensure the code meets W3C standards with no errors or warnings.* Maintain consistent design and functionality across different browsers.* Your output is only one HTML file, do not present any other notes on the HTML. Also, try your best to visualize the whole content.⠀Create the most effective and visually appealing webpage based on the uploaded file's content type (document, data, images, etc.)."
@@ -900,492 +1781,109 @@ def process_stream():
     if len(content) > 100000:
         system_prompt += "\nEXTREMELY LARGE CONTENT DETECTED: Break the content into multiple pages and implement a navigation system. Do not use complex or heavy JavaScript frameworks. Keep CSS minimal and efficient."
     
-    # Prepare user prompt - limit content size to avoid timeouts
-    content_limit = min(len(content), 100000)  # Limit to 100k characters
+    # Prepare user prompt - limit content tokens to avoid timeouts and stay inside the context window
+    content_token_limit = min(
+        STREAM_CONTENT_MAX_TOKENS,
+        TOTAL_CONTEXT_WINDOW - max_tokens - token_counter.count(system_prompt) - 1000
+    )
+    if content_token_limit < min(STREAM_CONTENT_MIN_TOKENS, token_counter.count(content)):
+        # Truncating the document to (almost) nothing would generate a page without it
+        return jsonify({
+            "success": False,
+            "error": f"max_tokens={max_tokens} leaves no room for the content in the {TOTAL_CONTEXT_WINDOW}-token context window; lower max_tokens"
+        }), 400
     user_content = f"""
     {format_prompt}
     
     Here is the content to transform into a website:
     
-    {content[:content_limit]}
+    {token_counter.truncate(content, content_token_limit)}
     """
     
-    # Define a streaming response generator with specific Claude 3.7 implementation
-    def stream_generator():
+    # The same content and settings were generated before: replay that result unless the client opts out
+    cache_key = generation_cache_key('claude', content, format_prompt, model, temperature, max_tokens, thinking_budget)
+    use_cache = data.get('use_cache', True)
+    if use_cache:
+        # Cached and shared generations are served without calling the model, so the key is checked first
         try:
-            yield format_stream_event("stream_start", {"message": "Stream starting", "session_id": session_id})
-            
-            # Add retry logic with exponential backoff
-            max_retries = MAX_RETRIES
-            retry_count = 0
-            backoff_time = MIN_BACKOFF_DELAY  # Start with minimum delay
-            
-            while retry_count <= max_retries:
-                try:
-                    # Use the Claude 3.7 specific implementation with beta parameter
-                    with client.beta.messages.stream(
-                        model="claude-3-7-sonnet-20250219",
-                        max_tokens=max_tokens,
-                        temperature=temperature,
-                        system=system_prompt,
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": user_content
-                                    }
-                                ]
-                            }
-                        ],
-                        thinking={
-                            "type": "enabled",
-                            "budget_tokens": thinking_budget
-                        },
-                        betas=[OUTPUT_128K_BETA],  # Using betas parameter instead of headers
-                    ) as stream:
-                        message_id = str(uuid.uuid4())
-                        generated_text = ""
-                        start_time = time.time()
-                        chunk_count = 0
-                        
-                        # Store accumulated HTML for segmented delivery
-                        html_segments = []
-                        current_segment = ""
-                        current_segment_size = 0
-                        segment_counter = 0
-                        max_segment_size = MAX_SEGMENT_SIZE  # 16KB per segment
-                        
-                        # Add checkpoint tracking
-                        last_checkpoint_time = time.time()
-                        checkpoint_counter = 0
-                        
-                        for chunk in stream:
-                            # Handle potential disconnection by saving state frequently
-                            try:
-                                current_time = time.time()
-                                chunk_count += 1
-                                
-                                # Update session cache with current progress
-                                if session_id in session_cache:
-                                    session_cache[session_id]['last_updated'] = current_time
-                                    session_cache[session_id]['chunk_count'] = chunk_count
-                                
-                                # More frequent keepalive messages (every STREAM_CHUNK_SIZE chunks)
-                                if chunk_count % STREAM_CHUNK_SIZE == 0:
-                                    yield format_stream_event("keepalive", {
-                                        "timestamp": current_time,
-                                        "session_id": session_id,
-                                        "chunk_count": chunk_count
-                                    })
-                                
-                                # Handle thinking updates
-                                if hasattr(chunk, "thinking") and chunk.thinking:
-                                    thinking_data = {
-                                        "type": "thinking_update",
-                                        "chunk_id": f"{message_id}_{chunk_count}",
-                                        "thinking": {
-                                            "content": chunk.thinking.content if hasattr(chunk.thinking, "content") else ""
-                                        }
-                                    }
-                                    yield format_stream_event("content", thinking_data)
-                                
-                                # Handle content block deltas (the actual generated text)
-                                if hasattr(chunk, "delta") and hasattr(chunk.delta, "text"):
-                                    delta_text = chunk.delta.text
-                                    generated_text += delta_text
-                                    
-                                    # Update session cache with generated text
-                                    if session_id in session_cache:
-                                        session_cache[session_id]['generated_text'] = generated_text
-                                    
-                                    # Check if we need to create a checkpoint (every 2 minutes)
-                                    if current_time - last_checkpoint_time > CHECKPOINT_INTERVAL:
-                                        checkpoint_id = f"cp_{session_id}_{checkpoint_counter}"
-                                        checkpoint_counter += 1
-                                        last_checkpoint_time = current_time
-                                        
-                                        # Store checkpoint in the session cache
-                                        session_cache[session_id]["checkpoints"] = session_cache[session_id].get("checkpoints", {})
-                                        session_cache[session_id]["checkpoints"][checkpoint_id] = {
-                                            "html_so_far": generated_text,
-                                            "chunk_id": f"{message_id}_{chunk_count}",
-                                            "timestamp": current_time,
-                                            "chunk_count": chunk_count
-                                        }
-                                        
-                                        # Send a checkpoint event
-                                        yield format_stream_event("status", {
-                                            "type": "checkpoint",
-                                            "checkpoint_id": checkpoint_id,
-                                            "timestamp": current_time,
-                                            "chunk_id": f"{message_id}_{chunk_count}",
-                                            "chunk_count": chunk_count,
-                                            "message": "Progress checkpoint created"
-                                        })
-                                    
-                                    # Build up the current segment
-                                    current_segment += delta_text
-                                    current_segment_size += len(delta_text)
-                                    
-                                    # Check if we should close and send this segment
-                                    # We send segments when they reach max size or contain complete HTML tags
-                                    if (current_segment_size >= max_segment_size or 
-                                        (current_segment_size > 256 and  # Reduced from 512 bytes to 256 bytes
-                                         (delta_text.endswith('</div>') or 
-                                          delta_text.endswith('</section>') or
-                                          delta_text.endswith('</p>') or
-                                          delta_text.endswith('</table>') or
-                                          delta_text.endswith('</li>') or
-                                          delta_text.endswith('</h1>') or
-                                          delta_text.endswith('</h2>') or
-                                          delta_text.endswith('</h3>') or
-                                          delta_text.endswith('</html>')))):
-                                        
-                                        # Store this segment
-                                        html_segments.append(current_segment)
-                                        segment_counter += 1
-                                        
-                                        # Update session cache with segments
-                                        if session_id in session_cache:
-                                            session_cache[session_id]['html_segments'] = html_segments.copy()
-                                        
-                                        # Send segment to client
-                                        content_data = {
-                                            "type": "content_block_delta",
-                                            "chunk_id": f"{message_id}_{chunk_count}",
-                                            "delta": {
-                                                "text": current_segment
-                                            },
-                                            "segment": segment_counter,
-                                            "session_id": session_id,
-                                            "chunk_count": chunk_count
-                                        }
-                                        yield format_stream_event("content", content_data)
-                                        
-                                        # Send a keepalive after every segment to maintain connection
-                                        yield format_stream_event("keepalive", {
-                                            "timestamp": time.time(),
-                                            "session_id": session_id,
-                                            "chunk_count": chunk_count,
-                                            "segment": segment_counter
-                                        })
-                                        
-                                        # Reset for next segment
-                                        current_segment = ""
-                                        current_segment_size = 0
-                                        
-                                        # Add a short sleep to let the browser process
-                                        if segment_counter % 3 == 0:  # Reduced from 5 to 3
-                                            time.sleep(0.05)
-                                    
-                                    # For smaller updates, send frequently to maintain connection
-                                    # Send even small updates every 2 chunks (reduced from 5)
-                                    elif chunk_count % 2 == 0 and current_segment:
-                                        content_data = {
-                                            "type": "content_block_delta",
-                                            "chunk_id": f"{message_id}_{chunk_count}",
-                                            "delta": {
-                                                "text": current_segment
-                                            },
-                                            "partial": True,
-                                            "session_id": session_id,
-                                            "chunk_count": chunk_count
-                                        }
-                                        yield format_stream_event("content", content_data)
-                                
-                            except (ConnectionError, BrokenPipeError) as e:
-                                app.logger.error(f"Client disconnected during streaming: {str(e)}")
-                                # Save the current state for potential reconnection
-                                app.logger.warning(f"Saving state at chunk {chunk_count} for session {session_id}")
-                                
-                                # Make sure session cache is updated before breaking
-                                if session_id in session_cache:
-                                    session_cache[session_id]['generated_text'] = generated_text
-                                    session_cache[session_id]['html_segments'] = html_segments.copy()
-                                    session_cache[session_id]['chunk_count'] = chunk_count
-                                break
-                        
-                        # If we have any remaining segment, send it
-                        if current_segment:
-                            html_segments.append(current_segment)
-                            segment_counter += 1
-                            content_data = {
-                                "type": "content_block_delta",
-                                "chunk_id": f"{message_id}_{chunk_count}",
-                                "delta": {
-                                    "text": current_segment
-                                },
-                                "segment": segment_counter,
-                                "session_id": session_id,
-                                "chunk_count": chunk_count
-                            }
-                            yield format_stream_event("content", content_data)
-                        
-                        # If we completed the stream successfully and have content
-                        if len(generated_text) > 0:
-                            # Stream completed successfully, break out of retry loop
-                            break
-                        else:
-                            # If we broke out of the loop due to connection issue but have partial results
-                            # Log the state for reconnection
-                            app.logger.warning(f"Partial completion for session {session_id}, chunk count: {chunk_count}")
-                            # Don't break here, let it retry if needed
-                
-                except Exception as e:
-                    error_str = str(e)
-                    error_details = ""
-                    
-                    # Check if it's an API error with a response
-                    if hasattr(e, 'response') and hasattr(e.response, 'json'):
-                        try:
-                            error_details = e.response.json()
-                            app.logger.error(f"API Error details: {error_details}")
-                            
-                            # Check specifically for overloaded error (529)
-                            if isinstance(error_details, dict) and error_details.get('code') == 529:
-                                if retry_count < max_retries:
-                                    retry_count += 1
-                                    
-                                    # Calculate backoff with jitter to prevent thundering herd
-                                    jitter = random.uniform(0.8, 1.2)
-                                    wait_time = min(backoff_time * jitter, MAX_BACKOFF_DELAY)
-                                    backoff_time = min(backoff_time * BACKOFF_FACTOR, MAX_BACKOFF_DELAY)
-                                    
-                                    app.logger.warning(f"Anthropic API overloaded. Retry {retry_count}/{max_retries} after {wait_time:.2f}s")
-                                    yield format_stream_event("status", {
-                                        "type": "status", 
-                                        "message": f"Anthropic API temporarily overloaded. Retrying in {wait_time:.1f}s (attempt {retry_count}/{max_retries})...",
-                                        "session_id": session_id,
-                                        "retry": retry_count,
-                                        "max_retries": max_retries
-                                    })
-                                    
-                                    time.sleep(wait_time)
-                                    continue  # Try again
-                                else:
-                                    app.logger.error(f"Max retries ({max_retries}) exceeded for API overload")
-                                    yield format_stream_event("error", {
-                                        "type": "error",
-                                        "error": "Maximum retry attempts exceeded. Please try again later.",
-                                        "details": "The AI service is currently experiencing high load. Your request could not be completed after multiple attempts.",
-                                        "code": 529,
-                                        "session_id": session_id
-                                    })
-                                    return
-                        except Exception as json_err:
-                            app.logger.error(f"Failed to parse error response: {str(json_err)}")
-                    
-                    # For other errors that are not 529
-                    app.logger.error(f"Error in stream_generator: {error_str}")
-                    if error_details:
-                        app.logger.error(f"Error details: {error_details}")
-                    
-                    # Yield error and exit
-                    yield format_stream_event("error", {
-                        "type": "error",
-                        "error": error_str,
-                        "details": str(error_details),
-                        "session_id": session_id
-                    })
-                    return
-            
-            # Send message complete event with usage statistics when available
-            try:
-                usage_data = None
-                if hasattr(stream, "usage"):
-                    usage_data = {
-                        "input_tokens": stream.usage.input_tokens if hasattr(stream.usage, "input_tokens") else 0,
-                        "output_tokens": stream.usage.output_tokens if hasattr(stream.usage, "output_tokens") else 0
-                    }
-                    # Calculate cost according to Anthropic pricing
-                    usage_data["total_cost"] = (usage_data["input_tokens"] / 1000000 * 3.0) + (usage_data["output_tokens"] / 1000000 * 15.0)
-                else:
-                    # If usage is not available from stream, calculate manually
-                    system_prompt_tokens = len(system_prompt) // 3
-                    content_tokens = len(user_content) // 4
-                    output_tokens = len(generated_text) // 4
-                    
-                    usage_data = {
-                        "input_tokens": system_prompt_tokens + content_tokens,
-                        "output_tokens": output_tokens,
-                        "time_elapsed": round(time.time() - start_time, 2),
-                        "total_cost": (system_prompt_tokens + content_tokens) / 1000000 * 3.0 + output_tokens / 1000000 * 15.0
-                    }
-                
-                # Mark this session as complete in the cache
-                if session_id in session_cache:
-                    session_cache[session_id]['complete'] = True
-                    session_cache[session_id]['usage'] = usage_data
-                
-                complete_data = {
-                    "type": "message_complete",
-                    "message_id": message_id,
-                    "chunk_id": f"{message_id}_{chunk_count}",
-                    "usage": usage_data,
-                    "html": generated_text,
-                    "session_id": session_id,
-                    "final_chunk_count": chunk_count,
-                    "segment_count": segment_counter
-                }
-                yield format_stream_event("content", complete_data)
-                yield format_stream_event("stream_end", {"message": "Stream complete", "session_id": session_id})
-            except (ConnectionError, BrokenPipeError) as e:
-                app.logger.error(f"Client disconnected during completion: {str(e)}")
-        except Exception as e:
-            app.logger.error(f"Unexpected error in stream generator: {str(e)}")
-            # Include stack trace for better debugging
-            app.logger.error(traceback.format_exc())
-            yield format_stream_event("error", {
-                "type": "error",
-                "error": str(e),
-                "details": traceback.format_exc(),
-                "session_id": session_id
-            })
+            anthropic_key_verifier.verify(api_key)
+        except InvalidAPIKeyError as e:
+            return jsonify({
+                "success": False,
+                "error": f"API key validation failed: {str(e)}"
+            }), 401
+    cached_generation = generation_cache.get(cache_key) if use_cache else None
+    if cached_generation is not None:
+        app.logger.info(f"Serving session {session_id} from the generation cache")
+        session_data = cached_generation_session(
+            cached_generation,
+            format_prompt=format_prompt,
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            thinking_budget=thinking_budget
+        )
+        session_cache[session_id] = session_data
+        session_cache.persist(session_id, reset_segments=True)
+        html_segments = session_data['html_segments']
+        for segment_num, segment in html_segments.segments_after(0):
+            session_cache.append_segment(session_id, segment_num, segment, html_segments.chunk_count(segment_num))
+        return event_stream_response(stream_session(session_id, session_data))
     
-    # Generator for resuming from cache
-    def resume_from_cache(session_id, last_chunk_id, api_key):
-        try:
-            # Get cached data
-            cached_data = session_cache[session_id]
-            app.logger.info(f"Resuming from cache for session {session_id}")
-            
-            # Start with a stream_start event
-            yield format_stream_event("stream_start", {
-                "message": "Resuming stream",
-                "session_id": session_id,
-                "is_resumed": True
-            })
-            
-            # Extract segment number from last_chunk_id
-            last_segment = 0
-            if last_chunk_id and '_' in last_chunk_id:
-                try:
-                    last_segment = int(last_chunk_id.split('_')[1]) // 10  # Approximate segment
-                except ValueError:
-                    pass
-            
-            # Send all cached segments after the last known segment
-            html_segments = cached_data.get('html_segments', [])
-            
-            for i, segment in enumerate(html_segments):
-                segment_num = i + 1
-                if segment_num > last_segment:
-                    content_data = {
-                        "type": "content_block_delta",
-                        "chunk_id": f"{session_id}_{segment_num * 10}",
-                        "delta": {
-                            "text": segment
-                        },
-                        "segment": segment_num,
-                        "session_id": session_id,
-                        "chunk_count": segment_num * 10,
-                        "is_cached": True
-                    }
-                    yield format_stream_event("content", content_data)
-                    time.sleep(0.1)  # Short delay between segments
-            
-            # If generation was complete, send the completion event
-            if cached_data.get('complete', False):
-                app.logger.info(f"Sending cached completion for session {session_id}")
-                
-                complete_data = {
-                    "type": "message_complete",
-                    "message_id": session_id,
-                    "chunk_id": f"{session_id}_{len(html_segments) * 10}",
-                    "usage": cached_data.get('usage', {}),
-                    "html": cached_data.get('generated_text', ''),
-                    "session_id": session_id,
-                    "final_chunk_count": len(html_segments) * 10,
-                    "segment_count": len(html_segments),
-                    "is_cached": True
-                }
-                yield format_stream_event("content", complete_data)
-                yield format_stream_event("stream_end", {
-                    "message": "Stream complete (from cache)",
-                    "session_id": session_id
-                })
-                return
-            
-            # If generation was not complete, continue with the regular generator
-            # Create a client and continue where we left off
-            client = create_anthropic_client(api_key)
-            
-            # Continue with a new request
-            app.logger.info(f"Continuing generation for session {session_id}")
-            
-            # Continue by creating a new generator
-            content = cached_data.get('user_content', '')
-            format_prompt = cached_data.get('format_prompt', '')
-            max_tokens = cached_data.get('max_tokens', DEFAULT_MAX_TOKENS)
-            temperature = cached_data.get('temperature', 0.5)
-            
-            # Add a message that we're continuing generation
-            yield format_stream_event("status", {
-                "type": "status",
-                "message": "Continuing generation...",
-                "session_id": session_id
-            })
-            
-            # Continue with new generator - simplified to avoid nesting too deep
-            # In production, this should be refactored to avoid code duplication
-            yield from stream_generator()
-            
-        except Exception as e:
-            app.logger.error(f"Error resuming from cache: {str(e)}")
-            yield format_stream_event("error", {
-                "type": "error",
-                "error": f"Failed to resume: {str(e)}",
-                "session_id": session_id
-            })
-            
-            # Start a new generator from scratch as fallback
-            yield format_stream_event("status", {
-                "type": "status",
-                "message": "Failed to resume. Starting new generation.",
-                "session_id": session_id
-            })
-            
-            # Re-initialize session
-            session_cache[session_id] = {
-                'created_at': time.time(),
-                'last_updated': time.time(),
-                'html_segments': [],
-                'generated_text': '',
-                'chunk_count': 0
-            }
-            
-            yield from stream_generator()
+    # Create Anthropic client
+    client = None
+    try:
+        client = create_anthropic_client(api_key)
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"API key validation failed: {str(e)}"
+        })
     
-    # Return streaming response
-    response = Response(stream_with_context(stream_generator()), 
-                         content_type='text/event-stream')
-    response.headers['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
-    response.headers['Cache-Control'] = 'no-cache, no-transform'
-    response.headers['Connection'] = 'keep-alive'
-    response.headers['Keep-Alive'] = 'timeout=3600, max=2000'  # 60 minutes timeout (increased from 30)
-    response.headers['X-Accel-Limit-Rate'] = '0'  # Disable rate limiting
-    return response
-
-# Clean up expired sessions from cache
-@app.before_request
-def cleanup_session_cache():
-    current_time = time.time()
-    expired_sessions = []
+    # Initialize session cache for this request
+    output_buffer = OutputBuffer()
+    session_data = {
+        'created_at': time.time(),
+        'last_updated': time.time(),
+        'html_segments': SegmentLog(output_buffer),
+        'generated_text': output_buffer,
+        'chunk_count': 0,
+        'user_content': content[:100000],  # Store for potential reconnection
+        'format_prompt': format_prompt,
+        'model': model,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'thinking_budget': thinking_budget,
+        'cache_key': cache_key,
+        'events': StreamEventLog(max_events=STREAM_EVENT_LOG_MAX_EVENTS),
+        'active': True,
+        'followers': 0,  # Responses currently streaming this session in this process
+        'last_followed': time.time()
+    }
     
-    for session_id, session_data in session_cache.items():
-        # Clean up sessions older than SESSION_CACHE_EXPIRY
-        if current_time - session_data.get('created_at', 0) > SESSION_CACHE_EXPIRY:
-            expired_sessions.append(session_id)
+    # An identical request is being generated right now: follow its stream instead of starting another.
+    # A request that opts out of the cache asks for a fresh generation, so it neither joins nor is joined.
+    if use_cache:
+        running = claim_generation(cache_key, session_id, session_data)
+        if running is not None:
+            running_id, running_data = running
+            app.logger.info(f"Session {session_id} joins the identical generation running in session {running_id}")
+            # Reconnects under this request's own session_id resume the shared generation
+            session_cache[session_id] = {'alias_of': running_id, 'created_at': time.time(), 'last_updated': time.time()}
+            session_cache.persist(session_id)
+            return event_stream_response(stream_session(running_id, running_data))
     
-    # Remove expired sessions
-    for session_id in expired_sessions:
-        del session_cache[session_id]
-        
-    # Log cleanup if sessions were removed
-    if expired_sessions:
-        app.logger.info(f"Cleaned up {len(expired_sessions)} expired sessions from cache")
+    session_cache[session_id] = session_data
+    session_cache.persist(session_id)
+    
+    # Run the generation in the background; the response follows it through the session
+    threading.Thread(
+        target=run_claude_generation,
+        args=(session_id, session_data, client, system_prompt, user_content, max_tokens, temperature, thinking_budget),
+        daemon=True
+    ).start()
+    
+    return event_stream_response(stream_session(session_id, session_data))
 
 # Add a simple test endpoint
 @app.route('/api/test', methods=['GET', 'POST'])
@@ -1447,18 +1945,17 @@ def test_generate():
         # Record start time
         start_time = time.time()
         
-        # Implement retry logic with exponential backoff
-        max_retries = 5
-        retry_count = 0
-        base_delay = 1  # Start with 1 second (in seconds)
+        # Retry transient failures under the shared retry policy
+        retry = UPSTREAM_RETRY_POLICY.start()
         success = False
         response = None
         html_output = None
         error_message = None
+        error_code = None
         
-        while retry_count <= max_retries and not success:
+        while not success:
             try:
-                print(f"Calling Anthropic API with test message (attempt {retry_count + 1}/{max_retries + 1})")
+                print(f"Calling Anthropic API with test message (attempt {retry.retries + 1})")
                 # Call Anthropic API with minimal settings
                 response = client.messages.create(
                     model="claude-3-haiku-20240307",  # Use smaller model to save tokens
@@ -1485,15 +1982,16 @@ def test_generate():
                 
             except Exception as e:
                 error_message = str(e)
-                print(f"Error in API call attempt {retry_count + 1}: {error_message}")
+                print(f"Error in API call attempt {retry.retries + 1}: {error_message}")
                 
-                # Check if this is an overloaded error (529)
-                is_overloaded = "529" in error_message and "Overloaded" in error_message
+                # Retry connection errors and the statuses the policy treats as transient (408, 429, 500, 502-504, 529)
+                error_code = error_status(e)
+                wait_time = None
+                if error_code is not None or isinstance(e, anthropic.APIConnectionError):
+                    wait_time = retry.next_delay(error_code, error_retry_after(e))
                 
-                if is_overloaded and retry_count < max_retries:
-                    retry_count += 1
-                    wait_time = base_delay * (2 ** (retry_count - 1))  # Exponential backoff
-                    print(f"Anthropic API overloaded. Retry {retry_count}/{max_retries} after {wait_time}s")
+                if wait_time is not None:
+                    print(f"Anthropic API {'returned ' + str(error_code) if error_code else 'connection failed'}. Retry {retry.retries}/{UPSTREAM_RETRY_POLICY.max_retries} after {wait_time:.1f}s")
                     time.sleep(wait_time)
                     continue
                 else:
@@ -1505,10 +2003,10 @@ def test_generate():
         
         # If successful, return the generated HTML
         if success and html_output:
-            # Calculate token usage (estimates)
-            system_prompt_tokens = len(system_prompt) // 3
-            content_tokens = len(truncated_content) // 4
-            output_tokens = len(html_output) // 4
+            # Calculate token usage (local counts)
+            system_prompt_tokens = token_counter.count(system_prompt)
+            content_tokens = token_counter.count(truncated_content)
+            output_tokens = token_counter.count(html_output)
             
             # Return response with HTML and token usage statistics
             return jsonify({
@@ -1525,7 +2023,7 @@ def test_generate():
             })
         else:
             # Return an error message with nice HTML
-            is_overloaded = error_message and "529" in error_message and "Overloaded" in error_message
+            is_overloaded = error_code == 529
             
             error_html = f"""
             <html>
@@ -1560,7 +2058,7 @@ def test_generate():
                     "time_elapsed": elapsed_time,
                     "total_cost": 0
                 },
-                "retries_attempted": retry_count,
+                "retries_attempted": retry.retries,
                 "test_mode": True
             }), 200  # Return 200 even with error since we're providing valid HTML
             
@@ -1594,7 +2092,68 @@ def test_generate():
             "test_mode": True
         }), 200  # Return 200 for better client handling
 
-def gemini_task(api_key, content, format_prompt, max_tokens, temperature,new_guid):
+def new_job_record(job_id):
+    """Create the result cache record of a queued Gemini job."""
+    return {
+        'state': 'queued',
+        'html': None,
+        'chunks': 0,
+        'bytes': 0,
+        'created_at': time.time(),
+        # Long polls wait on this for state changes; it shares the entry's lock
+        'changed': threading.Condition(result_cache.lock_for(job_id))
+    }
+
+
+def set_job_state(job_id, state, **fields):
+    """Update a Gemini job record, wake long polls and refresh its size in the result cache."""
+    with result_cache.lock_for(job_id):
+        job = result_cache.get(job_id)
+        if job is None:
+            return
+        job.update(state=state, **fields)
+        job['changed'].notify_all()
+        if state in ('done', 'failed'):
+            # Storing the record again starts its expiry from the moment the job finished
+            result_cache[job_id] = job
+            return
+    result_cache.touch(job_id)
+
+
+def job_elapsed(job):
+    """Seconds a job has been running (or ran, once finished)."""
+    started_at = job.get('started_at')
+    if started_at is None:
+        return 0
+    return round((job.get('finished_at') or time.time()) - started_at, 1)
+
+
+def job_status_payload(job):
+    """Build the /api/process-gemini-result response body for a job record."""
+    payload = {
+        "html": job.get('html'),
+        "state": job['state'],
+        "progress": {
+            "chunks": job.get('chunks', 0),
+            "bytes": job.get('bytes', 0),
+            "elapsed": job_elapsed(job)
+        },
+        "created_at": job.get('created_at'),
+        "started_at": job.get('started_at'),
+        "finished_at": job.get('finished_at')
+    }
+    if job.get('usage'):
+        payload["usage"] = job['usage']
+    if job.get('error'):
+        payload["error"] = job['error']
+    if job['state'] == 'queued':
+        payload["queue_depth"] = gemini_executor.queue_depth
+    return payload
+
+
+def gemini_task(api_key, content, format_prompt, max_tokens, temperature,new_guid, cache_key=None):
+    set_job_state(new_guid, 'running', started_at=time.time())
+    progress = StreamProgressLogger(f"gemini job={new_guid}")
     try:
 
         # Prepare user message with content and additional prompt
@@ -1630,14 +2189,19 @@ Here is the content to transform into a website:
         )
 
         result_str = ''
+        usage_metadata = None
         for chunk in client.models.generate_content_stream(
                 model=model,
                 contents=contents,
                 config=generate_content_config,
         ):
-            result_str+=chunk.text
-            print('\n\n\n')
-            print(result_str)
+            text = chunk.text or ''
+            result_str+=text
+            progress.chunk(text)
+            usage_metadata = getattr(chunk, 'usage_metadata', None) or usage_metadata
+            # Progress doesn't wake long polls; they pick it up with the next state change or timeout
+            result_cache.update(new_guid, chunks=progress.chunks, bytes=progress.bytes)
+        progress.finish()
 
         # Extract the HTML from the response
         html_content = result_str
@@ -1700,23 +2264,29 @@ Here is the content to transform into a website:
 </html>
 """
 
-        # Get usage stats (approximate since Gemini doesn't provide exact token counts)
-        input_tokens = len(prompt.split()) * 1.3  # Rough estimate: ~1.3 tokens per word
-        output_tokens = len(html_content.split()) * 1.3
-
-        # Ensure we don't have zero tokens (minimum of source length / 3)
-        input_tokens = max(len(content.split()) * 1.3, input_tokens)
-
-        # Round to integers
-        input_tokens = max(1, int(input_tokens))
-        output_tokens = max(1, int(output_tokens))
+        # Get usage stats: the counts Gemini reports when available (they also calibrate local counts), else local counts
+        input_tokens = getattr(usage_metadata, 'prompt_token_count', None) if usage_metadata else None
+        output_tokens = getattr(usage_metadata, 'candidates_token_count', None) if usage_metadata else None
+        if input_tokens:
+            token_counter.calibrate('gemini', prompt, input_tokens)
+        else:
+            input_tokens = token_counter.count(prompt, 'gemini')
+        if not output_tokens:
+            output_tokens = token_counter.count(html_content, 'gemini')
+        usage = {
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': input_tokens + output_tokens,
+            'total_cost': 0.0  # Gemini API is currently free
+        }
 
         # Log response
         print(f"Successfully generated HTML with Gemini. Input tokens: {input_tokens}, Output tokens: {output_tokens}")
 
-        print(html_content)
+        write_debug_artifact(GEMINI_DEBUG_ARTIFACT_DIR, f"gemini-{new_guid}", html_content)
 
-        result_cache[new_guid] = html_content
+        set_job_state(new_guid, 'done', html=html_content, usage=usage, finished_at=time.time())
+        cache_generation(cache_key, html_content, usage)
 
         # Return the response
         # return {
@@ -1735,6 +2305,7 @@ Here is the content to transform into a website:
         traceback_str = traceback.format_exc()
         print(f"Error in /api/process-gemini: {error_message}")
         print(f"Traceback: {traceback_str}")
+        progress.finish(state="failed")
 
         # Create a graceful fallback error page as HTML
         error_html = f"""
@@ -1767,7 +2338,7 @@ Here is the content to transform into a website:
         </html>
         """
 
-        result_cache[new_guid] = error_html
+        set_job_state(new_guid, 'failed', html=error_html, error=error_message, finished_at=time.time())
         # Return error as both JSON and HTML
         # return {
         #     'error': f'Server error: {error_message}',
@@ -1781,13 +2352,29 @@ def process_gemini_result():
     if not data:
         return jsonify({"error": "No data provided"}), 400
 
-    # Extract the API key and content
+    # Extract the task id
     uuid = data.get('uuid')
-
-    if uuid in result_cache:
-        return jsonify({"html": result_cache[uuid]}), 200
-    else:
-        return jsonify({"html": None}), 200
+    # With consume, the result is removed once it has been delivered
+    consume = bool(data.get('consume', RESULT_CACHE_DELETE_ON_FETCH))
+    # With wait, block up to that many seconds until the job leaves the state the client last saw
+    try:
+        wait = min(max(float(data.get('wait', 0) or 0), 0), GEMINI_RESULT_MAX_WAIT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    # Read and consume under the job's lock so the worker can't finish in between
+    with result_cache.lock_for(uuid):
+        job = result_cache.get(uuid)
+        if job is None:
+            return jsonify({"html": None, "state": "unknown", "error": "Unknown or expired task"}), 404
+        if wait and job['state'] not in ('done', 'failed'):
+            known_state = data.get('state') or job['state']
+            job['changed'].wait_for(lambda: job['state'] != known_state, timeout=wait)
+        payload = job_status_payload(job)
+        # Only finished jobs are consumed; queued and running ones are still being polled
+        if consume and job['state'] in ('done', 'failed'):
+            result_cache.pop(uuid)
+    return jsonify(payload), 200
 
 
 @app.route('/api/process-gemini', methods=['POST'])
@@ -1805,6 +2392,13 @@ def process_gemini():
     # Extract the API key and content
     api_key = data.get('api_key')
     content = data.get('content')
+    # Content can also reference a document uploaded to /api/documents
+    try:
+        document = lookup_document(data)
+    except KeyError as e:
+        return unknown_document_response(e.args[0])
+    if document:
+        content = document['text']
     format_prompt = data.get('format_prompt', '')
     max_tokens = int(data.get('max_tokens', GEMINI_MAX_OUTPUT_TOKENS))
     temperature = float(data.get('temperature', GEMINI_TEMPERATURE))
@@ -1821,14 +2415,57 @@ def process_gemini():
             'error': 'Google Generative AI package is not installed on the server.'
         }), 500
 
+    # The same content and settings were generated before: the job is done already unless the client opts out
+    cache_key = generation_cache_key('gemini', content, format_prompt, GEMINI_MODEL, temperature, max_tokens)
+    use_cache = data.get('use_cache', True)
+    if use_cache:
+        # A cached result is served without calling Gemini, so the key is checked first
+        try:
+            gemini_key_verifier.verify(api_key)
+        except InvalidAPIKeyError as e:
+            return jsonify({'error': f'API key validation failed: {str(e)}'}), 401
+    cached_generation = generation_cache.get(cache_key) if use_cache else None
+
     new_guid = str(uuid.uuid4())
-    # Start the task in a new thread
-    task_thread = threading.Thread(target=gemini_task, args=(api_key, content, format_prompt, max_tokens, temperature,new_guid))
-    task_thread.start()
-    #task_thread.join()
+    result_cache[new_guid] = new_job_record(new_guid)
+
+    if cached_generation is not None:
+        print(f"Serving Gemini task {new_guid} from the generation cache")
+        now = time.time()
+        set_job_state(new_guid, 'done', html=cached_generation['html'],
+                      usage=dict(cached_generation.get('usage') or {}, cached=True),
+                      started_at=now, finished_at=now)
+        return jsonify({
+            "status": "Task completed from cache",
+            "uuid": new_guid,
+            "state": "done",
+            "cached": True
+        }), 202
 
-    # Return a response indicating the task has started
-    return jsonify({"status": "Task started","uuid":new_guid}), 202
+    # Queue the task on the bounded Gemini pool
+    try:
+        gemini_executor.submit(gemini_task, api_key, content, format_prompt, max_tokens, temperature, new_guid, cache_key)
+    except QueueFullError:
+        result_cache.pop(new_guid)
+        print(f"Gemini queue full ({gemini_executor.queue_depth} waiting), rejecting request")
+        response = jsonify({
+            "error": "Server is busy processing other requests, please try again shortly",
+            "queue_depth": gemini_executor.queue_depth
+        })
+        response.headers['Retry-After'] = str(GEMINI_RETRY_AFTER)
+        return response, 429
+    except RuntimeError as e:
+        # The pool has been shut down (e.g. the worker is exiting)
+        result_cache.pop(new_guid)
+        return jsonify({"error": f"Gemini processing is unavailable: {str(e)}"}), 503
+
+    # Return a response indicating the task has been queued
+    return jsonify({
+        "status": "Task started",
+        "uuid": new_guid,
+        "state": "queued",
+        "queue_depth": gemini_executor.queue_depth
+    }), 202
 
 
 # # Add a new route for Gemini API processing
@@ -1883,6 +2520,14 @@ def process_gemini_stream():
     content = data.get('content', '')
     if not content:
         content = data.get('source', '')  # Fallback to 'source' if 'content' is empty
+
+    # Content can also reference a document uploaded to /api/documents
+    try:
+        document = lookup_document(data)
+    except KeyError as e:
+        return unknown_document_response(e.args[0])
+    if document:
+        content = document['text']
     
     # If content is empty, return an error
     if not content:
@@ -1911,11 +2556,12 @@ def process_gemini_stream():
         })
     
     # Initialize session cache for this request
+    output_buffer = OutputBuffer()
     session_cache[session_id] = {
         'created_at': time.time(),
         'last_updated': time.time(),
-        'html_segments': [],
-        'generated_text': '',
+        'html_segments': SegmentLog(output_buffer),
+        'generated_text': output_buffer,
         'chunk_count': 0,
         'user_content': content[:100000],  # Store for potential reconnection
         'format_prompt': format_prompt,
@@ -1930,7 +2576,7 @@ def process_gemini_stream():
 
 Here is the content to transform into a website:
 
-{content[:100000]}
+{token_counter.truncate(content, STREAM_CONTENT_MAX_TOKENS, 'gemini')}
 """
     
     if format_prompt:
@@ -1977,7 +2623,7 @@ Here is the content to transform into a website:
                 print("Successfully created Gemini stream response object")
                 
                 # Use our custom streaming response class
-                with GeminiStreamingResponse(stream_response, session_id) as gemini_stream:
+                with GeminiStreamingResponse(stream_response, session_id, token_counter=token_counter, prompt=prompt) as gemini_stream:
                     print(f"Entering GeminiStreamingResponse context with session ID: {session_id}")
                     chunk_count = 0
                     for chunk in gemini_stream:
@@ -0,0 +1,490 @@
+# Session storage for resumable streams
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from stream_buffers import OutputBuffer, SegmentLog, StreamEventLog
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_entry_size(entry):
+    """Rough size of a cache entry in characters (strings and buffers only)."""
+    if isinstance(entry, dict):
+        size = 0
+        for value in entry.values():
+            if isinstance(value, (str, bytes)) or hasattr(value, 'getvalue'):
+                size += len(value)
+        return size
+    if isinstance(entry, (str, bytes)):
+        return len(entry)
+    return 0
+
+
+def _persistable_fields(entry):
+    """Return the JSON-serializable metadata of a session entry."""
+    fields = {}
+    for key, value in entry.items():
+        if isinstance(value, (str, int, float, bool, type(None), list, dict)):
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            fields[key] = value
+    return fields
+
+
+class SessionBackend:
+    """
+    Interface for persisting resumable session state outside the process.
+
+    SessionStore keeps live sessions in memory and writes through to its
+    backend: session metadata when a session is created or finishes, and
+    each HTML segment as it is closed. A reconnect that lands on a process
+    without the session in memory rebuilds it from the backend.
+    """
+    def save_session(self, session_id, fields, reset_segments=False):
+        pass
+
+    def append_segment(self, session_id, number, text, chunk_count):
+        pass
+
+    def touch_session(self, session_id, updated_at):
+        """Record that the session's generation was still running at updated_at."""
+        pass
+
+    def load_session(self, session_id, after_segment=0):
+        """Return (fields, [(number, text, chunk_count), ...] after after_segment) or None."""
+        return None
+
+    def delete_session(self, session_id):
+        pass
+
+    def expire(self, created_before):
+        pass
+
+    def mark_followed(self, session_id, followed_at):
+        """Record that a response in this process was following the session at followed_at."""
+        pass
+
+    def last_followed(self, session_id):
+        """Return when a response in any process last marked the session followed, or None."""
+        return None
+
+
+class MemorySessionBackend(SessionBackend):
+    """Keeps sessions only in the in-process store (single worker, lost on restart)."""
+
+
+class SqliteSessionBackend(SessionBackend):
+    """
+    Session backend stored in a SQLite database in WAL mode.
+
+    Every worker process opens the same file, so a reconnect can be served by
+    any worker and sessions survive a restart. Connections are per thread.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, fields TEXT NOT NULL, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "session_id TEXT NOT NULL, number INTEGER NOT NULL, "
+                "text TEXT NOT NULL, chunk_count INTEGER NOT NULL, "
+                "PRIMARY KEY (session_id, number))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS followers ("
+                "session_id TEXT PRIMARY KEY, followed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_created_at ON sessions (created_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn)
+
+    def save_session(self, session_id, fields, reset_segments=False):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, fields, created_at, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET fields = excluded.fields, updated_at = excluded.updated_at",
+                (session_id, json.dumps(fields), fields.get("created_at", now), now)
+            )
+            if reset_segments:
+                conn.execute("DELETE FROM segments WHERE session_id = ?", (session_id,))
+
+    def append_segment(self, session_id, number, text, chunk_count):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO segments (session_id, number, text, chunk_count) VALUES (?, ?, ?, ?)",
+                (session_id, number, text, chunk_count)
+            )
+            conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (time.time(), session_id))
+
+    def touch_session(self, session_id, updated_at):
+        with self._connection() as conn:
+            conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (updated_at, session_id))
+
+    def load_session(self, session_id, after_segment=0):
+        with self._connection() as conn:
+            row = conn.execute("SELECT fields, updated_at FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            segments = conn.execute(
+                "SELECT number, text, chunk_count FROM segments WHERE session_id = ? AND number > ? ORDER BY number",
+                (session_id, after_segment)
+            ).fetchall()
+        fields = json.loads(row[0])
+        fields["last_updated"] = max(fields.get("last_updated", 0), row[1])
+        return fields, segments
+
+    def delete_session(self, session_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM segments WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM followers WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def expire(self, created_before):
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM segments WHERE session_id IN (SELECT session_id FROM sessions WHERE created_at < ?)",
+                (created_before,)
+            )
+            conn.execute(
+                "DELETE FROM followers WHERE session_id IN (SELECT session_id FROM sessions WHERE created_at < ?)",
+                (created_before,)
+            )
+            conn.execute("DELETE FROM sessions WHERE created_at < ?", (created_before,))
+
+    def mark_followed(self, session_id, followed_at):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO followers (session_id, followed_at) VALUES (?, ?)",
+                (session_id, followed_at)
+            )
+
+    def last_followed(self, session_id):
+        with self._connection() as conn:
+            row = conn.execute("SELECT followed_at FROM followers WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+
+class _Transaction:
+    """Run the statements of a `with` block in one SQLite transaction."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def create_session_backend(kind, path=None):
+    """Build a session backend from a config name ('memory' or 'sqlite')."""
+    if not kind or kind == "memory":
+        return MemorySessionBackend()
+    if kind == "sqlite":
+        return SqliteSessionBackend(path)
+    raise ValueError(f"Unknown session store backend: {kind}")
+
+
+class SessionStore:
+    """
+    Bounded in-memory cache for per-session state.
+
+    Entries expire `ttl` seconds after they are stored (storing an entry
+    again restarts its ttl). Expiry times are kept in a min-heap and a
+    background sweeper thread pops expired entries, so request handlers never
+    have to scan the cache. When the store grows past `max_entries` or
+    `max_bytes`, the least recently used entries are evicted. Passing None for
+    any of these limits disables it. Entries for which `pinned(entry)` is true
+    are neither expired nor evicted until it turns false.
+
+    The store is safe to share between request threads, stream generators and
+    background tasks. Its own lock is only held for short dictionary
+    operations; changes to a single entry are serialized with `lock_for(key)`,
+    which hands out one of `lock_stripes` locks so concurrent streams for
+    different sessions rarely contend.
+
+    An optional SessionBackend makes sessions resumable across workers and
+    restarts: `persist()` and `append_segment()` write through to it and
+    `load()` falls back to it when a session is not in memory.
+    """
+    def __init__(self, ttl=3600, max_entries=1000, max_bytes=512 * 1024 * 1024,
+                 sweep_interval=30, size_of=estimate_entry_size, name="session-store",
+                 lock_stripes=64, backend=None, pinned=None):
+        self.backend = backend or MemorySessionBackend()
+        self.pinned = pinned
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.size_of = size_of
+        self.name = name
+
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # Least recently used first
+        self._expires_at = {}
+        self._expiry_heap = []  # (expires_at, key); stale items are skipped when popped
+        self._sizes = {}
+        self._total_bytes = 0
+
+        self._stripes = [threading.RLock() for _ in range(max(1, lock_stripes))]
+
+        self._sweeper = None
+        self._stop_event = threading.Event()
+
+    # Mapping interface
+
+    def __setitem__(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            if self.ttl is not None:
+                expires_at = time.time() + self.ttl
+                self._expires_at[key] = expires_at
+                heapq.heappush(self._expiry_heap, (expires_at, key))
+            self._set_size(key, entry)
+            self._enforce_budget()
+        if self.ttl is not None:
+            self._ensure_sweeper()
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            return entry
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                raise KeyError(key)
+            self._remove(key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        """Return a snapshot of the keys, safe to iterate while the store changes."""
+        with self._lock:
+            return list(self._entries.keys())
+
+    def items(self):
+        """Return a snapshot of the (key, entry) pairs."""
+        with self._lock:
+            return list(self._entries.items())
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    # Per-entry locking
+
+    def lock_for(self, key):
+        """Return the lock that serializes changes to a single entry."""
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def update(self, key, **fields):
+        """Set fields on a dict entry under its lock. Returns False if the entry is gone."""
+        with self.lock_for(key):
+            entry = self.get(key)
+            if entry is None:
+                return False
+            entry.update(fields)
+            return True
+
+    # Backend write-through
+
+    def persist(self, key, reset_segments=False):
+        """Write an entry's metadata to the backend, optionally dropping its stored segments."""
+        with self.lock_for(key):
+            entry = self.get(key)
+            if entry is None:
+                return
+            fields = _persistable_fields(entry)
+        try:
+            self.backend.save_session(key, fields, reset_segments=reset_segments)
+        except Exception as e:
+            logger.error(f"{self.name}: failed to persist {key}: {str(e)}")
+
+    def append_segment(self, key, number, text, chunk_count):
+        """Write a closed segment to the backend."""
+        try:
+            self.backend.append_segment(key, number, text, chunk_count)
+        except Exception as e:
+            logger.error(f"{self.name}: failed to persist segment {number} of {key}: {str(e)}")
+
+    def heartbeat(self, key):
+        """Tell the backend an entry's generation is still running, without rewriting its metadata."""
+        try:
+            self.backend.touch_session(key, time.time())
+        except Exception as e:
+            logger.error(f"{self.name}: failed to refresh {key}: {str(e)}")
+
+    def load(self, key):
+        """Return an entry from memory, or rebuild it from the backend if possible."""
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        try:
+            stored = self.backend.load_session(key)
+        except Exception as e:
+            logger.error(f"{self.name}: failed to load {key}: {str(e)}")
+            return None
+        if stored is None:
+            return None
+
+        fields, segments = stored
+        output_buffer = OutputBuffer()
+        html_segments = SegmentLog(output_buffer)
+        for _, text, chunk_count in segments:
+            output_buffer.append(text)
+            html_segments.close_segment(len(output_buffer), chunk_count)
+        entry = dict(fields)
+        entry['generated_text'] = output_buffer
+        entry['html_segments'] = html_segments
+        entry['events'] = StreamEventLog()
+        # No generation runs for this entry in this process, and no response follows it yet
+        entry['active'] = False
+        entry['followers'] = 0
+        entry['rehydrated'] = True
+        if entry.get('complete'):
+            entry['events'].close()
+        with self.lock_for(key):
+            existing = self.get(key)
+            if existing is not None:
+                return existing
+            self[key] = entry
+        return entry
+
+    # Bookkeeping
+
+    def touch(self, key):
+        """Mark an entry as recently used and refresh its size after it has grown."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self._entries.move_to_end(key)
+            self._set_size(key, entry)
+            self._enforce_budget()
+
+    def sweep(self, now=None):
+        """Remove every expired entry and return their keys."""
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                expires_at, key = heapq.heappop(self._expiry_heap)
+                if self._expires_at.get(key) != expires_at:
+                    continue
+                if self._is_pinned(key):
+                    # Check again after another ttl
+                    self._expires_at[key] = now + self.ttl
+                    heapq.heappush(self._expiry_heap, (now + self.ttl, key))
+                    continue
+                self._remove(key)
+                expired.append(key)
+        if expired:
+            logger.info(f"{self.name}: expired {len(expired)} entries")
+        if self.ttl is not None:
+            try:
+                self.backend.expire(now - self.ttl)
+            except Exception as e:
+                logger.error(f"{self.name}: backend expiry failed: {str(e)}")
+        return expired
+
+    def _set_size(self, key, entry):
+        size = self.size_of(entry) if self.size_of else 0
+        self._total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+    def _is_pinned(self, key):
+        return self.pinned is not None and self.pinned(self._entries[key])
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._expires_at.pop(key, None)
+        self._total_bytes -= self._sizes.pop(key, 0)
+        return entry
+
+    def _enforce_budget(self):
+        evicted = 0
+        while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes and self._total_bytes > self.max_bytes and len(self._entries) > 1)):
+            key = next((key for key in self._entries if not self._is_pinned(key)), None)
+            if key is None:
+                # Everything left is pinned; the budget is enforced once entries are unpinned
+                break
+            self._remove(key)
+            evicted += 1
+        if evicted:
+            logger.info(f"{self.name}: evicted {evicted} least recently used entries")
+        # Drop stale heap items once they clearly outnumber live entries
+        if len(self._expiry_heap) > 2 * len(self._entries) + 64:
+            self._expiry_heap = [(expires_at, key) for key, expires_at in self._expires_at.items()]
+            heapq.heapify(self._expiry_heap)
+
+    # Background expiry
+
+    def _ensure_sweeper(self):
+        # Started lazily so the thread is created in the worker process, not before a fork
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        with self._lock:
+            if self._sweeper is not None and self._sweeper.is_alive():
+                return
+            self._stop_event.clear()
+            self._sweeper = threading.Thread(target=self._sweep_loop, name=f"{self.name}-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_loop(self):
+        while not self._stop_event.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"{self.name}: sweep failed: {str(e)}")
+
+    def stop_sweeper(self):
+        self._stop_event.set()
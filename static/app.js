@@ -1515,7 +1515,10 @@ async function generateGeminiHTML(apiKey, source, formatPrompt, maxTokens, tempe
         }
 
         const requestBody2 = {
-            uuid :data.uuid
+            uuid :data.uuid,
+            consume: true, // The server can free the result once we have it
+            wait: 10, // Long poll: the server answers when the job state changes or after 10 seconds
+            state: data.state
         }
 
         var html = '';
@@ -1526,12 +1529,20 @@ async function generateGeminiHTML(apiKey, source, formatPrompt, maxTokens, tempe
                 body: JSON.stringify(requestBody2)
             });
             result = await response.json();
-            console.log(result.html);
+            if (result.state === 'unknown') {
+                throw new Error(result.error || 'Gemini task not found');
+            }
             if(result.html) {
                 html = result.html
                 break
             }
-            await new Promise(resolve => setTimeout(resolve, 1000)); // 等待1秒再次尝试
+            requestBody2.state = result.state;
+            if (result.state === 'queued') {
+                setProcessingText(`Waiting for a free Gemini worker (${result.queue_depth || 0} jobs queued)...`);
+            } else if (result.progress) {
+                const kb = (result.progress.bytes / 1024).toFixed(1);
+                setProcessingText(`Generating with Google Gemini... ${result.progress.chunks} chunks, ${kb} KB, ${Math.round(result.progress.elapsed)}s elapsed`);
+            }
         }
         console.log(html);
 
@@ -1541,10 +1552,11 @@ async function generateGeminiHTML(apiKey, source, formatPrompt, maxTokens, tempe
         updateHtmlDisplay(html);
         updatePreview(html);
         
-        // Update usage statistics if available
-        if (data.usage) {
-            console.log('Received usage statistics from non-streaming API:', data.usage);
-            updateUsageStatistics(data.usage);
+        // Update usage statistics if available (reported with the finished job)
+        const usage = result.usage || data.usage;
+        if (usage) {
+            console.log('Received usage statistics from non-streaming API:', usage);
+            updateUsageStatistics(usage);
         } else {
             // If no usage data provided, estimate tokens
             const estimatedInputTokens = Math.max(1, Math.floor(source.length / 3.5));
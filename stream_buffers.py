@@ -0,0 +1,193 @@
+# Append-only buffers used while streaming generated HTML
+import bisect
+import threading
+
+
+class OutputBuffer:
+    """
+    Append-only text buffer for streamed model output.
+
+    Deltas are kept as a list of chunks so that appending stays O(1) no matter
+    how much HTML has already been produced. The joined string is only built
+    when it is actually needed and is cached until the next append.
+
+    A stream generator may append while a reconnecting request reads, so every
+    operation holds the buffer's own lock.
+    """
+    def __init__(self, initial_text=""):
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._starts = []  # Offset of the first character of each chunk
+        self._length = 0
+        self._joined = None
+        if initial_text:
+            self.append(initial_text)
+
+    def append(self, text):
+        """Append a delta and return the new total length."""
+        if not text:
+            return self._length
+        with self._lock:
+            self._starts.append(self._length)
+            self._chunks.append(text)
+            self._length += len(text)
+            self._joined = None
+            return self._length
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def getvalue(self):
+        """Return the full text, joining the pending chunks at most once."""
+        with self._lock:
+            if self._joined is None:
+                self._joined = "".join(self._chunks)
+                # Collapse into a single chunk so the next join only pays for new text
+                self._chunks = [self._joined] if self._joined else []
+                self._starts = [0] if self._joined else []
+            return self._joined
+
+    def __str__(self):
+        return self.getvalue()
+
+    def slice(self, start, end=None):
+        """Return text[start:end] without joining the whole buffer."""
+        with self._lock:
+            end = self._length if end is None else min(end, self._length)
+            start = max(0, start)
+            if start >= end:
+                return ""
+            if self._joined is not None:
+                return self._joined[start:end]
+
+            index = bisect.bisect_right(self._starts, start) - 1
+            parts = []
+            position = start
+            while position < end:
+                chunk = self._chunks[index]
+                chunk_start = self._starts[index]
+                parts.append(chunk[position - chunk_start:end - chunk_start])
+                position = chunk_start + len(chunk)
+                index += 1
+            return "".join(parts)
+
+
+class SegmentLog:
+    """
+    Append-only log of the HTML segments sent to the client.
+
+    Segments are stored as end offsets into an OutputBuffer rather than as
+    copies of the text, so the session cache can hold a reference to the log
+    while the stream generator keeps appending to it. Segment numbers are
+    1-based to match the "segment" field of the SSE content events.
+    """
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._lock = threading.Lock()
+        self._ends = []
+        self._chunk_counts = []  # Stream chunk count at which each segment closed
+
+    def close_segment(self, end_offset=None, chunk_count=0):
+        """Record a segment ending at end_offset (default: end of buffer) and return its number."""
+        if end_offset is None:
+            end_offset = len(self.buffer)
+        with self._lock:
+            # Chunk counts first, so a reader that sees the new end also sees its count
+            self._chunk_counts.append(chunk_count)
+            self._ends.append(end_offset)
+            return len(self._ends)
+
+    def __len__(self):
+        return len(self._ends)
+
+    @property
+    def end_offset(self):
+        """Offset in the buffer where the next segment starts."""
+        return self._ends[-1] if self._ends else 0
+
+    def bounds(self, number):
+        """Return the (start, end) buffer offsets of a segment."""
+        start = self._ends[number - 2] if number > 1 else 0
+        return start, self._ends[number - 1]
+
+    def chunk_count(self, number):
+        """Return the stream chunk count at which a segment was closed."""
+        return self._chunk_counts[number - 1]
+
+    def segments_through_chunk(self, chunk_count):
+        """Return how many segments had been closed by the given stream chunk count."""
+        with self._lock:
+            return bisect.bisect_right(self._chunk_counts, chunk_count, 0, len(self._ends))
+
+    def segment(self, number):
+        """Return the text of a single segment."""
+        start, end = self.bounds(number)
+        return self.buffer.slice(start, end)
+
+    def segments_after(self, number):
+        """Yield (segment_number, text) for every segment after the given one."""
+        for current in range(max(number, 0) + 1, len(self._ends) + 1):
+            yield current, self.segment(current)
+
+    def __iter__(self):
+        for _, text in self.segments_after(0):
+            yield text
+
+
+class StreamEventLog:
+    """
+    Append-only list of SSE events published by a running generation.
+
+    The generation publishes (event_type, data) pairs and calls notify() when
+    new output is available; any number of response generators read from
+    their own cursor with wait(), blocking until something happens. close()
+    marks the generation as finished.
+
+    With `max_events`, only about the newest `max_events` events are kept
+    (thinking updates alone can number in the thousands). Cursors keep
+    counting every event ever published; a reader whose cursor points at a
+    dropped event continues from the oldest one still kept.
+    """
+    def __init__(self, max_events=None):
+        self.max_events = max_events
+        self._condition = threading.Condition()
+        self._events = []
+        self._dropped = 0  # Events discarded from the front of the log
+        self._closed = False
+
+    def publish(self, event_type, data):
+        with self._condition:
+            self._events.append((event_type, data))
+            # Trim in batches so publishing stays O(1) amortized
+            if self.max_events and len(self._events) >= 2 * self.max_events:
+                excess = len(self._events) - self.max_events
+                del self._events[:excess]
+                self._dropped += excess
+            self._condition.notify_all()
+
+    def notify(self):
+        """Wake readers without adding an event (e.g. after a segment closes)."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def __len__(self):
+        return self._dropped + len(self._events)
+
+    def wait(self, cursor, timeout):
+        """Return (events after cursor, new cursor, closed), waiting up to timeout for news."""
+        with self._condition:
+            if cursor >= len(self) and not self._closed:
+                self._condition.wait(timeout)
+            return self._events[max(cursor - self._dropped, 0):], len(self), self._closed
@@ -0,0 +1,71 @@
+# Progress logging for streamed model output
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StreamProgressLogger:
+    """
+    Logs how a streamed generation is progressing without logging what it generates.
+
+    Every chunk updates the counters (chunks, UTF-8 bytes); a summary line with
+    the throughput is written at most every `interval` seconds and once more
+    when the stream finishes. Lines are key=value pairs so they stay greppable.
+    """
+    def __init__(self, label, interval=5.0):
+        self.label = label
+        self.interval = interval
+        self.chunks = 0
+        self.bytes = 0
+        self.started_at = time.time()
+        self._last_report = self.started_at
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    def _summary(self):
+        elapsed = self.elapsed
+        rate = self.bytes / elapsed / 1024 if elapsed > 0 else 0.0
+        return f"chunks={self.chunks} bytes={self.bytes} elapsed={elapsed:.1f}s rate={rate:.1f}KB/s"
+
+    def chunk(self, text):
+        """Count a received chunk."""
+        self.chunks += 1
+        size = len(text.encode('utf-8')) if text else 0
+        self.bytes += size
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"{self.label} chunk={self.chunks} size={size}")
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            logger.info(f"{self.label} {self._summary()}")
+
+    def finish(self, state="done"):
+        """Log the final totals of the stream."""
+        level = logging.INFO if state == "done" else logging.WARNING
+        logger.log(level, f"{self.label} state={state} {self._summary()}")
+
+
+def write_debug_artifact(directory, name, text):
+    """
+    Write generated output to directory/name.html for debugging and return the path.
+
+    Does nothing (and returns None) when no directory is configured.
+    """
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+        path = os.path.join(directory, f"{safe_name}.html")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        logger.debug(f"Wrote debug artifact {path} ({len(text)} chars)")
+        return path
+    except OSError as e:
+        logger.warning(f"Could not write debug artifact {name}: {str(e)}")
+        return None
@@ -0,0 +1,32 @@
+import pytest
+
+from client_pool import InvalidAPIKeyError, KeyVerifier
+
+
+def test_rejected_keys_raise_and_accepted_keys_are_remembered():
+    checks = []
+    verifier = KeyVerifier(lambda api_key: checks.append(api_key) or api_key == "good")
+
+    with pytest.raises(InvalidAPIKeyError):
+        verifier.verify("bad")
+    with pytest.raises(InvalidAPIKeyError):
+        verifier.verify("  ")
+    verifier.verify("good")
+    verifier.verify("good")
+
+    assert checks == ["bad", "good"]
+
+
+def test_failed_checks_let_the_key_through_without_remembering_it():
+    outcomes = [RuntimeError("HTTP 529"), False]
+
+    def check(api_key):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    verifier = KeyVerifier(check)
+    verifier.verify("key")  # The provider couldn't answer: the request goes ahead
+    with pytest.raises(InvalidAPIKeyError):
+        verifier.verify("key")  # Checked again next time
@@ -0,0 +1,81 @@
+import json
+import threading
+import types
+import uuid
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+class BlockingStream:
+    """Message stream that sends one text delta, then waits until the test releases it."""
+    def __init__(self, release):
+        self.release = release
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def __iter__(self):
+        yield types.SimpleNamespace(delta=types.SimpleNamespace(text="<html><p>shared</p>"))
+        self.release.wait(10)
+        yield types.SimpleNamespace(delta=types.SimpleNamespace(text="</html>"))
+
+    def get_final_message(self):
+        return types.SimpleNamespace(usage=types.SimpleNamespace(input_tokens=10, output_tokens=5))
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    release = threading.Event()
+    calls = []
+
+    def stream(**kwargs):
+        calls.append(kwargs)
+        return BlockingStream(release)
+
+    client = types.SimpleNamespace(beta=types.SimpleNamespace(messages=types.SimpleNamespace(stream=stream)))
+    monkeypatch.setattr(server, "create_anthropic_client", lambda api_key: client)
+    monkeypatch.setattr(server.anthropic_key_verifier, "check", lambda api_key: True)
+    yield calls
+    release.set()
+
+
+def first_event(response):
+    """Read the first SSE event of a streamed response and return its data."""
+    chunk = next(iter(response.response))
+    if isinstance(chunk, bytes):
+        chunk = chunk.decode("utf-8")
+    data = [line for line in chunk.splitlines() if line.startswith("data: ")][0]
+    return json.loads(data[6:])
+
+
+def test_reconnecting_a_joined_stream_resumes_the_shared_generation(upstream):
+    client = server.app.test_client()
+    content = f"document {uuid.uuid4()}"
+    owner_id, joiner_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+    owner = client.post("/api/process-stream", json={
+        "api_key": "sk-test", "content": content, "session_id": owner_id
+    }, buffered=False)
+    assert first_event(owner)["session_id"] == owner_id
+
+    joiner = client.post("/api/process-stream", json={
+        "api_key": "sk-test", "content": content, "session_id": joiner_id
+    }, buffered=False)
+    assert first_event(joiner)["session_id"] == owner_id
+    joiner.close()  # The joining browser disconnects
+
+    resumed = client.post("/api/process-stream", json={
+        "api_key": "sk-test", "content": content, "session_id": joiner_id, "is_reconnect": True
+    }, buffered=False)
+    event = first_event(resumed)
+    assert event["session_id"] == owner_id
+    assert event["is_resumed"] is True
+    assert len(upstream) == 1
+
+    resumed.close()
+    owner.close()
@@ -0,0 +1,14 @@
+import pytest
+
+from retry_policy import RetryPolicy
+
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_gateway_errors_are_retried(status):
+    retry = RetryPolicy(base_delay=0.01, max_delay=0.02).start()
+    assert retry.next_delay(status) is not None
+
+
+def test_client_errors_are_not_retried():
+    retry = RetryPolicy().start()
+    assert retry.next_delay(400) is None
@@ -0,0 +1,59 @@
+import time
+
+import pytest
+
+from session_store import SessionStore, SqliteSessionBackend
+from stream_buffers import OutputBuffer, SegmentLog, StreamEventLog
+
+STALE_AFTER = 120  # server.SESSION_RESUME_STALE_AFTER
+
+
+def make_session(created_at):
+    output_buffer = OutputBuffer()
+    return {
+        'created_at': created_at,
+        'last_updated': created_at,
+        'html_segments': SegmentLog(output_buffer),
+        'generated_text': output_buffer,
+        'events': StreamEventLog(),
+        'active': True
+    }
+
+
+def test_heartbeat_keeps_session_without_segments_fresh_for_other_workers(tmp_path, monkeypatch):
+    path = str(tmp_path / "sessions.db")
+    owner = SessionStore(backend=SqliteSessionBackend(path), sweep_interval=None)
+    other = SessionStore(backend=SqliteSessionBackend(path), sweep_interval=None)
+
+    # Still thinking: persisted once when it started, no segment closed since
+    started = time.time() - 2 * STALE_AFTER
+    owner['s1'] = make_session(started)
+    with monkeypatch.context() as m:
+        m.setattr(time, 'time', lambda: started)
+        owner.persist('s1')
+
+    fields, segments = other.backend.load_session('s1')
+    assert segments == []
+    assert time.time() - fields['last_updated'] > STALE_AFTER
+
+    owner.heartbeat('s1')
+
+    fields, segments = other.backend.load_session('s1')
+    assert segments == []
+    assert time.time() - fields['last_updated'] < STALE_AFTER
+    assert fields['created_at'] == started
+    entry = other.load('s1')
+    assert entry['rehydrated'] and not entry['active']
+    assert time.time() - entry['last_updated'] < STALE_AFTER
+
+
+def test_active_sessions_survive_eviction_pressure():
+    server = pytest.importorskip("server")
+    store = SessionStore(max_entries=2, sweep_interval=None, pinned=server.session_cache.pinned)
+    store['running'] = make_session(time.time())
+    for number in range(3):
+        store[f'finished-{number}'] = dict(make_session(time.time()), active=False)
+
+    assert 'running' in store
+    assert 'finished-0' not in store
+    assert 'finished-2' in store
@@ -0,0 +1,38 @@
+import base64
+import io
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+@pytest.mark.parametrize("spill_threshold", [None, 16])
+def test_plain_upload_reads_the_file_part(monkeypatch, spill_threshold):
+    # With a threshold of 16 bytes the part is parsed into a spilled temporary file
+    monkeypatch.setattr(server, "UPLOAD_SPILL_THRESHOLD", spill_threshold)
+    content = b"%PDF-1.4 " + bytes(range(256)) * 4
+
+    response = server.app.test_client().post("/upload", data={
+        "file": (io.BytesIO(content), "report.pdf")
+    }, content_type="multipart/form-data")
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["file_name"] == "report.pdf"
+    assert base64.b64decode(body["file_content"]) == content
+
+
+@pytest.mark.parametrize("spill_threshold", [None, 4])
+def test_upload_buffer_reads_like_a_file(spill_threshold):
+    upload = server.UploadBuffer(spill_threshold=spill_threshold)
+    try:
+        upload.write(b"hello ")
+        upload.write(b"world")
+        upload.seek(0)
+        assert upload.readable() and upload.seekable()
+        assert upload.read(5) == b"hello"
+        assert upload.tell() == 5
+        assert upload.read() == b" world"
+        assert upload.spilled == (spill_threshold is not None)
+    finally:
+        upload.close()
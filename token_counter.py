@@ -0,0 +1,139 @@
+# Offline token counting for cost estimates and context-window checks
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"  # Kana, CJK ideographs, Hangul
+
+# Text split into the kinds of pieces tokenizers treat differently
+_PIECES = re.compile(
+    r"[A-Za-z]+"           # Latin words
+    r"|\d+"                # Digit runs
+    r"|[ ]+"               # Spaces
+    r"|\s+"                # Newlines, tabs and other whitespace
+    r"|[" + _CJK + r"]"    # CJK characters
+    r"|[^\sA-Za-z\d]"      # Punctuation, symbols, other scripts
+)
+_IS_CJK = re.compile(r"[" + _CJK + r"]")
+
+
+class TokenizerAdapter:
+    """
+    Approximates one provider's tokenizer from the shape of the text.
+
+    Latin words cost about one token per `letters_per_token` letters, digit
+    runs one per `digits_per_token` digits, CJK characters `cjk_per_char`
+    tokens each and any other symbol one token. A single space is folded into
+    the following word, as BPE tokenizers do. The result is multiplied by a
+    calibration factor learned from the token counts the provider reports.
+    """
+    def __init__(self, name, letters_per_token=4.0, digits_per_token=3.0, cjk_per_char=1.2):
+        self.name = name
+        self.letters_per_token = letters_per_token
+        self.digits_per_token = digits_per_token
+        self.cjk_per_char = cjk_per_char
+
+    def estimate(self, text):
+        """Uncalibrated token estimate of text."""
+        tokens = 0.0
+        for piece in _PIECES.findall(text):
+            first = piece[0]
+            if first.isascii() and first.isalpha():
+                tokens += math.ceil(len(piece) / self.letters_per_token)
+            elif first.isdigit():
+                tokens += math.ceil(len(piece) / self.digits_per_token)
+            elif first == ' ':
+                if len(piece) > 1:
+                    tokens += math.ceil((len(piece) - 1) / 4)
+            elif first.isspace():
+                tokens += 1
+            elif _IS_CJK.match(first):
+                tokens += self.cjk_per_char
+            else:
+                tokens += 1
+        return int(math.ceil(tokens))
+
+
+DEFAULT_ADAPTERS = {
+    'claude': TokenizerAdapter('claude', letters_per_token=4.0, digits_per_token=3.0, cjk_per_char=1.3),
+    'gemini': TokenizerAdapter('gemini', letters_per_token=4.5, digits_per_token=1.0, cjk_per_char=1.0),
+}
+
+
+class TokenCounter:
+    """
+    Counts tokens locally with per-provider adapters.
+
+    Estimates are memoized by the SHA-256 of the text (in an LRU of
+    `cache_size` entries), so analyzing the same document again is free.
+    calibrate() records the real token count reported for a text; the ratio
+    to our estimate is folded into a per-provider factor (an exponential
+    moving average, kept within [0.5, 2]) that scales later counts.
+    """
+    def __init__(self, adapters=None, cache_size=256, smoothing=0.2):
+        self.adapters = dict(adapters or DEFAULT_ADAPTERS)
+        self.cache_size = cache_size
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._estimates = OrderedDict()
+        self._factors = {name: 1.0 for name in self.adapters}
+        self._samples = {name: 0 for name in self.adapters}
+
+    def _adapter(self, provider):
+        return self.adapters.get(provider) or self.adapters['claude']
+
+    def _estimate(self, text, provider):
+        adapter = self._adapter(provider)
+        key = (adapter.name, hashlib.sha256(text.encode('utf-8', errors='ignore')).hexdigest())
+        with self._lock:
+            estimate = self._estimates.get(key)
+            if estimate is not None:
+                self._estimates.move_to_end(key)
+                return estimate
+        estimate = adapter.estimate(text)
+        with self._lock:
+            self._estimates[key] = estimate
+            while len(self._estimates) > self.cache_size:
+                self._estimates.popitem(last=False)
+        return estimate
+
+    def count(self, text, provider='claude'):
+        """Return the calibrated token count of text for a provider ('claude' or 'gemini')."""
+        if not text:
+            return 0
+        return max(1, int(round(self._estimate(text, provider) * self.factor(provider))))
+
+    def factor(self, provider):
+        return self._factors.get(self._adapter(provider).name, 1.0)
+
+    def calibrate(self, provider, text, actual_tokens):
+        """Adjust a provider's factor with the real token count the API reported for text."""
+        if not text or not actual_tokens:
+            return
+        name = self._adapter(provider).name
+        estimate = self._estimate(text, provider)
+        if not estimate:
+            return
+        ratio = min(2.0, max(0.5, actual_tokens / estimate))
+        with self._lock:
+            samples = self._samples[name]
+            # The first sample replaces the default; later ones are averaged in
+            weight = 1.0 if samples == 0 else self.smoothing
+            self._factors[name] += weight * (ratio - self._factors[name])
+            self._samples[name] = samples + 1
+
+    def truncate(self, text, max_tokens, provider='claude'):
+        """Return the longest prefix of text that fits in about max_tokens tokens."""
+        total = self.count(text, provider)
+        if total <= max_tokens:
+            return text
+        # Tokens are spread evenly enough for a proportional cut
+        return text[:max(0, int(len(text) * max_tokens / total))]
+
+    def stats(self):
+        """Calibration factors and sample counts per provider."""
+        with self._lock:
+            return {name: {'factor': round(self._factors[name], 4), 'samples': self._samples[name]}
+                    for name in self.adapters}